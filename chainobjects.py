@@ -1,9 +1,12 @@
 import bpy
-from mathutils import kdtree
 from itertools import permutations as perm
 from functools import lru_cache
 from time import time
 from math import factorial as fac
+from multiprocessing import get_context
+import sys
+import os
+import numpy as np
 
 bl_info = {
 	"name": "Chain selected objects",
@@ -64,38 +67,381 @@ def object_list2(objects, active=0):
 
 	s = time()
 
-	# calculate a kd tree to quickly answer nearest neighbor queries
-	kd = kdtree.KDTree(len(objects))
-	for i, ob in enumerate(objects):
-		kd.insert(ob.location, i)
-	kd.balance()
-
-	current = objects[active]
-	chain = [current]  # we start at the chosen object
-	added = {active}
-	for i in range(1,len(objects)):  # we know how many objects to add
-		# when looking for the nearest neighbor we start with two neigbors
-		# (because we include the object itself in the search) and if
-		# the other neigbors is not yet in the chain we add it, otherwise
-		# we expand our search to a maximum of the total number of objects
-		for n in range(2,len(objects)):
-			neighbors = { index for _,index,_ in kd.find_n(current.location, n) }
-			neighbors -= added
-			if neighbors:  # strictly speaking we shoudl assert that len(neighbors) == 1
-				chain.extend(objects[i] for i in neighbors)
-				added |= neighbors
-				break
-		current = chain[-1]
+	chain = nearest_neighbor_chain([ob.location for ob in objects], active)
 
 	print("{n:d} objects {t:.1f}s".format(t=time()-s, n=len(objects)))
 
+	return [objects[i] for i in chain]
+
+def nearest_neighbor_chain(locations, active=0):
+	"""
+	Return the indices of the locations in the order of the nearest
+	neighbor heuristic, starting at the active index.
+	"""
+
+	# an index that forgets every object once it is added to the chain,
+	# so the nearest object it returns is always the one to add next
+	index = NearestUnvisited(locations)
+
+	chain = [active]  # we start at the chosen object
+	index.remove(active)
+	for i in range(1,len(locations)):  # we know how many objects to add
+		current = index.nearest(index.points[chain[-1]])
+		index.remove(current)
+		chain.append(current)
+
 	return chain
 
+class NearestUnvisited:
+	"""
+	A kd-tree over a fixed set of locations that supports removing them.
+
+	The tree is implicit in a permutation of the location indices: the
+	node for the slice order[lo:hi] holds the location at the middle and
+	splits the rest on the axis where they are spread most. Every node
+	keeps the number of locations below it that are not removed yet, so
+	nearest() never enters an empty subtree and removing a location just
+	marks it and decrements the counts on its path, O(log n).
+	"""
+
+	def __init__(self, locations):
+		self.points = np.asarray(locations, dtype=np.float64).reshape(-1,3)
+		n = len(self.points)
+		self.order = np.arange(n)
+		self.axis = [0] * n
+		self._build()
+		self.order = self.order.tolist()
+		self.position = [0] * n  # position of every location in order
+		for i, j in enumerate(self.order):
+			self.position[j] = i
+		self.coords = self.points[self.order].tolist()  # coordinates in tree order
+		self.count = [0] * n
+		self._count(0, n)
+		self.removed = [False] * n
+
+	def _build(self):
+		stack = [(0, len(self.order))]
+		while stack:
+			lo, hi = stack.pop()
+			if hi - lo < 2:
+				continue
+			mid = (lo + hi) // 2
+			p = self.points[self.order[lo:hi]]
+			axis = int(np.argmax(np.max(p, axis=0) - np.min(p, axis=0)))
+			self.order[lo:hi] = self.order[lo:hi][np.argpartition(p[:, axis], mid - lo)]
+			self.axis[mid] = axis
+			stack.append((lo, mid))
+			stack.append((mid + 1, hi))
+
+	def _count(self, lo, hi):
+		# the node in the middle of order[lo:hi] counts hi - lo locations
+		if hi <= lo:
+			return 0
+		mid = (lo + hi) // 2
+		self.count[mid] = hi - lo
+		self._count(lo, mid)
+		self._count(mid + 1, hi)
+		return hi - lo
+
+	def __len__(self):
+		return self.count[len(self.order) // 2] if self.order else 0
+
+	def remove(self, index):
+		"""mark the location with this index as removed"""
+		if self.removed[index]:
+			return
+		self.removed[index] = True
+		target = self.position[index]
+		lo, hi = 0, len(self.order)
+		while True:
+			mid = (lo + hi) // 2
+			self.count[mid] -= 1
+			if mid == target:
+				break
+			if target < mid:
+				hi = mid
+			else:
+				lo = mid + 1
+
+	def nearest(self, location):
+		"""return the index of the nearest location that is not removed, or None"""
+		x = tuple(location)
+		coords, axis, count, order, removed = self.coords, self.axis, self.count, self.order, self.removed
+		best, bestd = None, float('inf')
+		stack = [(0, len(order), 0.0)]
+		while stack:
+			lo, hi, d = stack.pop()
+			if d >= bestd:
+				continue
+			mid = (lo + hi) // 2
+			if hi <= lo or count[mid] == 0:
+				continue
+			c = coords[mid]
+			if not removed[order[mid]]:
+				dd = (c[0]-x[0])**2 + (c[1]-x[1])**2 + (c[2]-x[2])**2
+				if dd < bestd:
+					best, bestd = order[mid], dd
+			a = axis[mid]
+			diff = x[a] - c[a]
+			# push the far side first so the near side is searched first
+			if diff < 0:
+				stack.append((mid + 1, hi, diff*diff))
+				stack.append((lo, mid, 0.0))
+			else:
+				stack.append((lo, mid, diff*diff))
+				stack.append((mid + 1, hi, 0.0))
+		return best
+
+def object_list3(objects, active=0, exact=16, starts=1, optimize=True, limit=500):
+	"""
+	Return a short path through objects starting at the active index.
+
+	Up to exact objects the shortest path is calculated with held_karp(),
+	for more objects the nearest neighbor chain is improved with 2-opt and
+	Or-opt moves until no move makes it any shorter. With starts > 1 this
+	is done in parallel for nearest neighbor chains from that many start
+	objects spread over the selection, each moved to begin at the active
+	object first, and the shortest chain is returned.
+
+	The improvement needs the full distance matrix and its time grows
+	quickly with the number of objects, so with optimize=False or more 
+	than limit objects the chains are not improved, only the shortest
+	plain nearest neighbor chain is returned.
+	"""
+
+	s = time()
+
+	locations = [ob.location for ob in objects]
+	n = len(objects)
+	optimize = optimize and n <= limit
+	if n <= exact:
+		chain = held_karp(distance_matrix(locations), active)
+	elif starts > 1:
+		chain = multi_start_chain(locations, spread_starts(locations, starts, active), optimize=optimize)
+	elif not optimize:
+		chain = nearest_neighbor_chain(locations, active)
+	else:
+		chain = improve(distance_matrix(locations), nearest_neighbor_chain(locations, active))
+
+	print("{n:d} objects {t:.1f}s".format(t=time()-s, n=len(objects)))
+
+	return [objects[i] for i in chain]
+
+def distance_matrix(locations):
+	"""
+	Return the (n,n) matrix of distances between all pairs of locations.
+	"""
+	p = np.asarray(locations, dtype=np.float64).reshape(-1,3)
+	diff = p[:,None,:] - p[None,:,:]
+	return np.sqrt(np.einsum('ijk,ijk->ij', diff, diff))
+
+def chain_length(D, chain):
+	return float(np.sum(D[chain[:-1], chain[1:]]))
+
+def path_length(p, chain):
+	"""
+	Return the length of the chain through the (n,3) array of locations p,
+	for when there is no distance matrix.
+	"""
+	step = np.diff(p[chain], axis=0)
+	return float(np.sum(np.sqrt(np.einsum('ij,ij->i', step, step))))
+
+def held_karp(D, start=0):
+	"""
+	Return the shortest path that starts at index start and visits every
+	index of the distance matrix D exactly once.
+
+	This is the Held-Karp dynamic programming algorithm: for every subset
+	of the other indices (a bitmask) and every last index in it the length
+	of the shortest path through that subset is kept. All subsets of the
+	same size are done at once, so its O(2**n n**2) work is mostly numpy
+	and about 20 objects (some 100 MB for the tables) is still feasible.
+	"""
+	n = len(D)
+	others = np.array([i for i in range(n) if i != start], dtype=np.int64)
+	m = len(others)
+	if m < 2:
+		return [start] + others.tolist()
+	Dm = D[np.ix_(others, others)]
+
+	masks = np.arange(1 << m, dtype=np.int64)
+	size = np.zeros(1 << m, dtype=np.int64)
+	for j in range(m):
+		size += (masks >> j) & 1
+	cost = np.full((1 << m, m), np.inf)
+	parent = np.zeros((1 << m, m), dtype=np.int8)
+	cost[1 << np.arange(m), np.arange(m)] = D[start, others]
+	for k in range(2, m+1):
+		subsets = masks[size == k]
+		for j in range(m):
+			last = subsets[(subsets >> j) & 1 == 1]
+			c = cost[last ^ (1 << j)] + Dm[:, j]
+			parent[last, j] = np.argmin(c, axis=1)
+			cost[last, j] = c[np.arange(len(last)), parent[last, j]]
+
+	mask = (1 << m) - 1
+	j = int(np.argmin(cost[mask]))
+	path = []
+	while mask:
+		path.append(j)
+		mask, j = mask ^ (1 << j), int(parent[mask, j])
+	return [start] + others[path[::-1]].tolist()
+
+def two_opt(D, chain):
+	"""
+	Improve the chain by reversing any part of it that makes it shorter,
+	until no such reversal is left. The first index stays in place. For
+	every first index of a part all possible ends are tried at once.
+	Return the improved chain and whether anything changed.
+	"""
+	c = np.array(chain, dtype=np.int64)
+	n = len(c)
+	changed = improved = False
+	while True:
+		improved = False
+		for i in range(1, n-1):
+			a, b = c[i-1], c[i]
+			k = np.arange(i+1, n)
+			# reversing c[i:k+1] replaces edges a-b and c[k]-c[k+1] by a-c[k] and b-c[k+1]
+			after = c[np.minimum(k+1, n-1)]
+			delta = D[a, c[k]] - D[a, b] + np.where(k < n-1, D[b, after] - D[c[k], after], 0.0)
+			best = int(np.argmin(delta))
+			if delta[best] < -1e-12:
+				c[i:k[best]+1] = c[i:k[best]+1][::-1].copy()
+				improved = changed = True
+		if not improved:
+			return c.tolist(), changed
+
+def or_opt(D, chain, maxlength=3):
+	"""
+	Improve the chain by moving short runs of up to maxlength consecutive
+	indices (possibly reversed) to another place where that makes it 
+	shorter, until no such move is left. The first index stays in place.
+	For every run all places to put it are tried at once.
+	Return the improved chain and whether anything changed.
+	"""
+	c = list(chain)
+	n = len(c)
+	changed = False
+	while True:
+		improved = False
+		for length in range(1, min(maxlength, n-2)+1):
+			i = 1
+			while i + length <= n:
+				first, last = c[i], c[i+length-1]
+				p = c[i-1]
+				if i + length < n:
+					q = c[i+length]
+					gain = D[p, first] + D[last, q] - D[p, q]
+				else:
+					gain = D[p, first]
+				rest = np.array(c[:i] + c[i+length:], dtype=np.int64)
+				x, y = rest[:-1], rest[1:]
+				# insert between x and y, forward or reversed, or at the end
+				forward = np.append(D[x, first] + D[last, y] - D[x, y], D[rest[-1], first])
+				backward = np.append(D[x, last] + D[first, y] - D[x, y], D[rest[-1], last])
+				f, b = int(np.argmin(forward)), int(np.argmin(backward))
+				if min(forward[f], backward[b]) < gain - 1e-12:
+					run = c[i:i+length]
+					if backward[b] < forward[f]:
+						run, f = run[::-1], b
+					rest = rest.tolist()
+					c = rest[:f+1] + run + rest[f+1:]
+					improved = changed = True
+				i += 1
+		if not improved:
+			return c, changed
+
+def improve(D, chain):
+	"""
+	Return the chain after alternating 2-opt and Or-opt until neither of
+	them can make it any shorter.
+	"""
+	while True:
+		chain, changed = two_opt(D, chain)
+		chain, changed = or_opt(D, chain)
+		if not changed:
+			return chain
+
+# set before the pool is forked, so every worker shares them with the parent
+_worker_locations = None
+_worker_distances = None
+_worker_first = None
+
+def _worker_length(chain):
+	if _worker_distances is None:
+		return path_length(_worker_locations, chain)
+	return chain_length(_worker_distances, chain)
+
+def _worker_chain(start):
+	chain = nearest_neighbor_chain(_worker_locations, start)
+	chain = anchor(_worker_length, chain, _worker_first)
+	if _worker_distances is not None:
+		chain = improve(_worker_distances, chain)
+	return _worker_length(chain), chain
+
+def anchor(length, chain, first):
+	"""
+	Return a chain through the same indices that starts at first. The
+	chain is cut at first, which continues with either part, and the part
+	not next to first anymore is reversed, whichever the function length
+	says is shorter.
+	"""
+	k = chain.index(first)
+	before, after = chain[:k][::-1], chain[k+1:]
+	return min([first] + before + after, [first] + after + before, key=length)
+
+def spread_starts(locations, n, first=0):
+	"""
+	Return n indices of locations that are far apart, beginning with first
+	and each next one as far as possible from those already chosen.
+	"""
+	p = np.asarray(locations, dtype=np.float64).reshape(-1,3)
+	starts = [first]
+	d = np.sum((p - p[first])**2, axis=1)
+	for i in range(1, min(n, len(p))):
+		starts.append(int(np.argmax(d)))
+		d = np.minimum(d, np.sum((p - p[starts[-1]])**2, axis=1))
+	return starts
+
+def multi_start_chain(locations, starts, processes=None, optimize=True):
+	"""
+	Return the shortest of the improved nearest neighbor chains that begin
+	at each of the start indices, all moved to start at starts[0] with
+	anchor() before they are improved, so the result starts there too.
+	With optimize=False the chains are not improved and no distance matrix
+	is calculated.
+
+	The chains are calculated by a pool of forked worker processes that
+	share one distance matrix with the parent. Forking is only safe on 
+	Linux (on macOS and Windows a process with Blender's threads cannot
+	be forked and a spawned one would have to import bpy), elsewhere the
+	chains are calculated one after another.
+	"""
+	global _worker_locations, _worker_distances, _worker_first
+	_worker_locations = np.asarray(locations, dtype=np.float64).reshape(-1,3)
+	_worker_distances = distance_matrix(_worker_locations) if optimize else None
+	_worker_first = starts[0]
+	try:
+		if sys.platform.startswith('linux') and len(starts) > 1:
+			with get_context('fork').Pool(min(len(starts), processes or os.cpu_count())) as pool:
+				results = pool.map(_worker_chain, starts)
+		else:
+			results = [_worker_chain(start) for start in starts]
+	finally:
+		_worker_locations = _worker_distances = None
+	return min(results, key=lambda r: r[0])[1]
+
 class ChainSelectedObjects(bpy.types.Operator):
 	bl_idname = 'object.chainselectedobjects'
 	bl_label = 'Chain selected objects'
 	bl_options = {'REGISTER', 'UNDO'}
 
+	starts = bpy.props.IntProperty(name="Start objects", default=1, min=1, max=64,
+		description="Try nearest neighbor chains from this many start objects in parallel and keep the shortest")
+	optimize = bpy.props.BoolProperty(name="Improve chain", default=True,
+		description="Shorten the nearest neighbor chain with 2-opt and Or-opt moves (selections of up to 500 objects)")
+
 	@classmethod
 	def poll(self, context):
 		return (context.mode == 'OBJECT' 
@@ -103,7 +449,7 @@ class ChainSelectedObjects(bpy.types.Operator):
 
 	def execute(self, context):
 		so = context.selected_objects.copy()
-		objects = object_list2(so, so.index(context.active_object))
+		objects = object_list3(so, so.index(context.active_object), starts=self.starts, optimize=self.optimize)
 		for ob in objects:
 			ob.select = False
 
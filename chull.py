@@ -46,15 +46,34 @@
 #
 # The Vector class is a tiny subset of the Blender Vector class, the
 #
+# By default Hull(points) uses an expected O(n log n) randomized 
+# incremental algorithm that keeps a conflict graph instead of checking
+# every face for every point. Hull(points, engine='quickhull') uses the
+# Quickhull algorithm with numpy (see chull_bench.py) and 
+# Hull(points, engine='incremental') the original O(n^2) algorithm.
+#
+# Hull(points, cull=True) first drops the points that lie inside the
+# polytope of a few extreme points, which saves a lot of work when most
+# points are inside the hull (needs numpy). Hull(points, processes=4) 
+# calculates the hulls of 4 chunks of the points in parallel first.
+#
 # Because the code is a rather straightforward implementation of the C
 # original, the code style is not very Pythonic.
  
+from array import array
+from math import sqrt
+from random import Random
+
 Z=2
 Y=1
 X=0
 
 debug = False
 
+class DegenerateHull(Exception):
+	"""raised when the points do not span a volume: too few of them, or all collinear or coplanar"""
+	pass
+
 class Vector:
 	def __init__(self,x,y,z):
 		self.x=x
@@ -216,18 +235,307 @@ REMOVED = True
 VISIBLE  = True
 PROCESSED = True
 
+class HalfEdges:
+	"""
+	HalfEdges keeps a closed triangle mesh in a few flat arrays instead of
+	linked Vertex, Edge and Face objects. Face f owns the half-edges 3f,
+	3f+1 and 3f+2: half-edge h starts at vertex origin[h], the next one 
+	around its face is h - h%3 + (h+1)%3 and twin[h] is the opposite
+	half-edge in the neighbouring face. Vertices are indices into coords.
+	Faces are ordered so that the normal of their plane (nx, ny, nz,
+	offset) points outward. Deleting a face only clears its alive flag 
+	and puts it on the free list, the next new face reuses the slot.
+	"""
+	def __init__(self,coords):
+		self.coords = coords # list of (x,y,z) tuples
+		self.origin = array('l')
+		self.twin = array('l')
+		self.nx = array('d')
+		self.ny = array('d')
+		self.nz = array('d')
+		self.offset = array('d')
+		self.alive = bytearray()
+		self.free = []
+	
+	def AddFace(self,u,v,w):
+		(ux,uy,uz), (vx,vy,vz), (wx,wy,wz) = self.coords[u], self.coords[v], self.coords[w]
+		ax, ay, az = vx-ux, vy-uy, vz-uz
+		bx, by, bz = wx-ux, wy-uy, wz-uz
+		nx, ny, nz = ay*bz - az*by, az*bx - ax*bz, ax*by - ay*bx
+		length = sqrt(nx*nx + ny*ny + nz*nz)
+		if length > 0:
+			nx, ny, nz = nx/length, ny/length, nz/length
+		offset = nx*ux + ny*uy + nz*uz
+		if self.free:
+			f = self.free.pop()
+			h = 3*f
+			self.origin[h], self.origin[h+1], self.origin[h+2] = u, v, w
+			self.twin[h] = self.twin[h+1] = self.twin[h+2] = -1
+			self.nx[f], self.ny[f], self.nz[f], self.offset[f] = nx, ny, nz, offset
+			self.alive[f] = True
+		else:
+			f = len(self.alive)
+			self.origin.extend((u,v,w))
+			self.twin.extend((-1,-1,-1))
+			self.nx.append(nx)
+			self.ny.append(ny)
+			self.nz.append(nz)
+			self.offset.append(offset)
+			self.alive.append(True)
+		return f
+	
+	def DeleteFace(self,f):
+		self.alive[f] = False
+		self.free.append(f)
+	
+	def Link(self,h,g):
+		self.twin[h] = g
+		self.twin[g] = h
+	
+	def Distance(self,f,p):
+		"""the signed distance of vertex p to the plane of face f, positive outside"""
+		x, y, z = self.coords[p]
+		return self.nx[f]*x + self.ny[f]*y + self.nz[f]*z - self.offset[f]
+	
+	def Faces(self):
+		return [f for f, alive in enumerate(self.alive) if alive]
+	
+	def Triangles(self):
+		o = self.origin
+		return [(o[3*f],o[3*f+1],o[3*f+2]) for f in self.Faces()]
+	
+	def FindTetrahedron(self,candidates,epsilon):
+		"""
+		FindTetrahedron returns the first four vertices among candidates
+		that span a tetrahedron of some volume, much like DoubleTriangle.
+		"""
+		c = self.coords
+		it = iter(candidates)
+		a = next(it)
+		ax, ay, az = c[a]
+		for b in it:
+			ux, uy, uz = c[b][0]-ax, c[b][1]-ay, c[b][2]-az
+			length = sqrt(ux*ux + uy*uy + uz*uz)
+			if length > epsilon:
+				break
+		else:
+			raise DegenerateHull("FindTetrahedron:  All points are Collinear!")
+		for d in it:
+			vx, vy, vz = c[d][0]-ax, c[d][1]-ay, c[d][2]-az
+			nx, ny, nz = uy*vz - uz*vy, uz*vx - ux*vz, ux*vy - uy*vx
+			area = sqrt(nx*nx + ny*ny + nz*nz)
+			if area > epsilon * length:
+				break
+		else:
+			raise DegenerateHull("FindTetrahedron:  All points are Collinear!")
+		for e in it:
+			wx, wy, wz = c[e][0]-ax, c[e][1]-ay, c[e][2]-az
+			if abs(nx*wx + ny*wy + nz*wz) > epsilon * area:
+				return a, b, d, e
+		raise DegenerateHull("FindTetrahedron:  All points are coplanar!")
+	
+	def Tetrahedron(self,a,b,c,d):
+		"""Tetrahedron adds the four faces of the tetrahedron abcd and returns them."""
+		f = self.AddFace(a,b,c)
+		if self.Distance(f,d) > 0:
+			self.DeleteFace(f)
+			self.free.pop()
+			a, b = b, a
+			f = self.AddFace(a,b,c)
+		faces = [f, self.AddFace(b,a,d), self.AddFace(c,b,d), self.AddFace(a,c,d)]
+		halfedges = {}
+		for f in faces:
+			for h in (3*f,3*f+1,3*f+2):
+				u, v = self.origin[h], self.origin[h - h%3 + (h+1)%3]
+				if (v,u) in halfedges:
+					self.Link(h, halfedges.pop((v,u)))
+				else:
+					halfedges[(u,v)] = h
+		return faces
+	
+	def AddCone(self,f,p,epsilon):
+		"""
+		AddCone replaces the faces visible from vertex p, a connected region
+		around the visible face f, by a cone of new faces between the 
+		horizon of that region and p. It returns the removed faces and the
+		new faces. The new faces never reuse the slots of the removed ones,
+		so callers can still look up data keyed by the removed faces.
+		"""
+		origin, twin = self.origin, self.twin
+		nx, ny, nz, offset = self.nx, self.ny, self.nz, self.offset
+		px, py, pz = self.coords[p]
+		visible = [f]
+		seen = {f}
+		for g in visible:
+			for h in (3*g,3*g+1,3*g+2):
+				k = twin[h] // 3
+				if k not in seen and nx[k]*px + ny[k]*py + nz[k]*pz - offset[k] > epsilon:
+					seen.add(k)
+					visible.append(k)
+		
+		horizon = [h for g in visible for h in (3*g,3*g+1,3*g+2) if twin[h] // 3 not in seen]
+		new = []
+		start = {} # vertex -> new face whose horizon edge starts there
+		for h in horizon:
+			u = origin[h]
+			g = self.AddFace(u, origin[h - h%3 + (h+1)%3], p)
+			self.Link(3*g, twin[h])
+			start[u] = g
+			new.append(g)
+		for g in new:
+			self.Link(3*g+1, 3*start[origin[3*g+1]]+2)
+		for g in visible:
+			self.DeleteFace(g)
+		return visible, new
+
+def InteriorCull(v, chunk=65536):
+	"""
+	InteriorCull returns the indices of the Vectors in v that are not 
+	strictly inside the polytope spanned by the extreme points along 13
+	directions (the axes, the face diagonals and the space diagonals of a
+	cube). This is the Akl-Toussaint heuristic: those points can never be
+	on the hull, so there is no need to add them one by one. The signed 
+	volume tests against all faces of the polytope are done in batches with
+	numpy. If the extreme points do not span a volume nothing is culled.
+	"""
+	import numpy as np
+	
+	p = np.array([(vc.x, vc.y, vc.z) for vc in v], dtype=np.float64).reshape(-1,3)
+	everything = list(range(len(p)))
+	directions = np.array([(i,j,k) for i in (-1,0,1) for j in (-1,0,1) for k in (-1,0,1) if (i,j,k) > (0,0,0)], dtype=np.float64)
+	if len(p) < 5:
+		return everything
+	projection = p @ directions.T
+	extremes = np.unique(np.concatenate((np.argmax(projection, axis=0), np.argmin(projection, axis=0))))
+	if len(extremes) < 4:
+		return everything
+	try:
+		polytope = Hull([v[i] for i in extremes])
+	except DegenerateHull: # extreme points coplanar or collinear
+		return everything
+	
+	tri = np.array([[(vt.v.x, vt.v.y, vt.v.z) for vt in f.vertex] for f in polytope.faces])
+	normal = np.cross(tri[:,1] - tri[:,0], tri[:,2] - tri[:,0])
+	offset = np.einsum('ij,ij->i', normal, tri[:,0])
+	# orient every plane so the inside is on the positive side
+	centroid = np.mean(p[extremes], axis=0)
+	flip = normal @ centroid - offset < 0
+	normal[flip] = -normal[flip]
+	offset[flip] = -offset[flip]
+	epsilon = 1e-10 * np.linalg.norm(normal, axis=1) * np.max(np.abs(p))
+	
+	inside = np.empty(len(p), dtype=bool)
+	for b in range(0, len(p), chunk):
+		inside[b:b+chunk] = np.all(p[b:b+chunk] @ normal.T - offset > epsilon, axis=1)
+	return np.flatnonzero(~inside).tolist()
+
+def HullVertices(chunk, engine='quickhull', cull=False):
+	"""
+	HullVertices returns the indices of the points in chunk, a list of 
+	(x,y,z) tuples, that are vertices of their convex hull, or all of them
+	if they do not span a volume. It runs in the worker processes of 
+	ParallelCull.
+	"""
+	try:
+		hull = Hull([Vector(*p) for p in chunk], engine=engine, cull=cull)
+	except DegenerateHull:
+		return list(range(len(chunk)))
+	return sorted(vt.vnum for vt in hull.vertices)
+
+def ParallelCull(v, processes, engine='quickhull', cull=False, minimum=1000):
+	"""
+	ParallelCull splits the Vectors in v into one chunk per process, 
+	calculates the hull of every chunk in a pool of processes and returns
+	the indices of the points that are a vertex of the hull of their 
+	chunk. A point inside the hull of its chunk is inside the hull of all
+	points, so the final hull only needs to look at the survivors.
+	With fewer than minimum points starting the pool costs more than it
+	saves, so all indices are returned and the serial hull does the work.
+	"""
+	from multiprocessing import Pool
+	
+	if len(v) < minimum:
+		return list(range(len(v)))
+	size = max(1, -(-len(v) // processes))
+	chunks = [[(vc.x, vc.y, vc.z) for vc in v[i:i+size]] for i in range(0, len(v), size)]
+	with Pool(processes) as pool:
+		survivors = pool.starmap(HullVertices, [(chunk, engine, cull) for chunk in chunks])
+	return [i*size + j for i, s in enumerate(survivors) for j in s]
+
 class Hull:
-	def __init__(self,v):
+	def __init__(self,v,engine='randomized',cull=False,processes=None):
+		"""
+		Calculate the convex hull of the list of Vectors v. 
+		
+		engine selects the algorithm: 'randomized' (the default) adds the
+		points in random order and keeps a conflict graph (expected 
+		O(n log n)), 'quickhull' repeatedly adds the point farthest outside
+		a face (needs numpy) and 'incremental' is the original O'Rourke 
+		algorithm that checks every face and edge for every added point 
+		(O(n^2)). Points that do not span a volume raise DegenerateHull.
+		All produce the same hull, only points on flat parts of the hull
+		may be kept by one and not by the other depending on the order 
+		they were added in.
+		
+		With cull=True the points that are certainly inside the hull are 
+		removed first by InteriorCull (this needs numpy).
+		
+		With processes=n the points are split in n chunks whose hulls are
+		calculated in parallel by ParallelCull with the same engine, and
+		only the vertices of those hulls are used for the final hull. Below
+		a thousand points this step is skipped.
+		"""
 		self.vertices = []
 		self.edges = []
 		self.faces = []
-		self.ReadVertices(v)
-		v=self.DoubleTriangle()
-		self.ConstructHull(v)
+		indices = range(len(v))
+		if processes:
+			indices = ParallelCull(v, processes, engine, cull)
+		if cull:
+			indices = [indices[i] for i in InteriorCull([v[i] for i in indices])]
+		self.ReadVertices(v, indices)
+		if engine == 'incremental':
+			v=self.DoubleTriangle()
+			self.ConstructHull(v)
+		elif engine == 'randomized':
+			self.RandomizedHull()
+		elif engine == 'quickhull':
+			self.Quickhull()
+		else:
+			raise ValueError("unknown engine %s"%engine)
 		self.EdgeOrderOnFaces()
 
-	def ReadVertices(self,v):
-		self.vertices = [ Vertex(vc,i) for i,vc in enumerate(v) ]
+	def ReadVertices(self,v,indices=None):
+		if indices is None:
+			indices = range(len(v))
+		self.vertices = [ Vertex(v[i],i) for i in indices ]
+		
+	def Materialize(self,triangles):
+		"""
+		Materialize replaces the edges and faces by new Edge and Face 
+		objects for the triangles, given as triples of indices into
+		self.vertices in the same (inward) orientation as the faces of the
+		other engines. Only vertices of some triangle are kept.
+		"""
+		vertices = self.vertices
+		self.faces = []
+		self.edges = []
+		edges = {} # (u,v) -> edge that still waits for the face across it
+		for t in triangles:
+			f = Face(vertex=[vertices[i] for i in t])
+			self.faces.append(f)
+			for k in (0,1,2):
+				u, v = t[k], t[(k+1)%3]
+				e = edges.pop((v,u), None)
+				if e is None:
+					e = Edge(endpts=[vertices[u],vertices[v]],adjface=[f,None])
+					edges[(u,v)] = e
+					self.edges.append(e)
+				else:
+					e.adjface[1] = f
+				f.edge[k] = e
+		used = sorted({i for t in triangles for i in t})
+		self.vertices = [vertices[i] for i in used]
 		
 	def EdgeOrderOnFaces(self):
 		"""
@@ -305,7 +613,7 @@ class Hull:
 		while(Vertex.Collinear(self.vertices[v0%nv],self.vertices[(v0+1)%nv],self.vertices[(v0+2)%nv])):
 			v0 = (v0+1)%nv
 			if v0 == 0:
-				raise Exception("DoubleTriangle:  All points are Collinear!")
+				raise DegenerateHull("DoubleTriangle:  All points are Collinear!")
 				
 		v1 = (v0+1)%nv
 		v2 = (v1+1)%nv
@@ -337,7 +645,7 @@ class Hull:
 		while vol == 0:
 			v3 = (v3+1)%nv
 			if v3==0:
-				raise Exception("DoubleTriangle:  All points are coplanar!")
+				raise DegenerateHull("DoubleTriangle:  All points are coplanar!")
 			vol = self.VolumeSign( f0, self.vertices[v3] )
 	
 		if debug: print(self.debug('initial'))
@@ -360,6 +668,137 @@ class Hull:
 			ev,v=self.CleanUp(ev,v) # cleanup may delete vertices!
 			if v == ev : break
 			
+	def RandomizedHull(self,seed=None):
+		"""
+		RandomizedHull builds the hull by adding the vertices in random
+		order. Every vertex that is not yet processed is linked to one face
+		that is visible from it (the conflict graph) or dropped if it is
+		inside the hull. Adding a vertex then only needs to look at the 
+		faces around its conflict face, and only the vertices linked to
+		the faces that are removed need a new conflict face: a new cone
+		face or the face across a horizon edge if they still see any.
+		The hull is kept in a HalfEdges mesh, there is no cleanup pass.
+		"""
+		
+		coords = [(v.v.x,v.v.y,v.v.z) for v in self.vertices]
+		if len(coords) < 4:
+			raise DegenerateHull("RandomizedHull:  Need at least 4 points!")
+		epsilon = 1e-10 * max(abs(c) for p in coords for c in p)
+		mesh = HalfEdges(coords)
+		distance = mesh.Distance
+		
+		order = list(range(len(coords)))
+		Random(seed).shuffle(order)
+		tetrahedron = mesh.FindTetrahedron(order, epsilon)
+		faces = mesh.Tetrahedron(*tetrahedron)
+		
+		conflict = {} # vertex -> one face visible from it
+		conflicts = {f:[] for f in faces} # face -> vertices linked to it
+		for q in order:
+			for f in faces:
+				if q not in tetrahedron and distance( f, q ) > epsilon:
+					conflict[q] = f
+					conflicts[f].append(q)
+					break
+		
+		for p in order:
+			f = conflict.pop(p, None)
+			if f is None: # p is inside the hull or part of the tetrahedron
+				continue
+			visible, new = mesh.AddCone( f, p, epsilon )
+			
+			# find a new conflict face for the vertices that lost theirs
+			candidates = new + [mesh.twin[3*g] // 3 for g in new] # and the faces across the horizon
+			for g in new:
+				conflicts[g] = []
+			for f in visible:
+				for q in conflicts.pop(f):
+					if q == p:
+						continue
+					del conflict[q]
+					for g in candidates:
+						if distance( g, q ) > epsilon:
+							conflict[q] = g
+							conflicts[g].append(q)
+							break
+		
+		# the faces of the other engines are oriented inward
+		self.Materialize([(u,w,v) for u,v,w in mesh.Triangles()])
+		
+	def Quickhull(self):
+		"""
+		Quickhull starts with a tetrahedron of extreme points and gives
+		every face the set of points outside it. It then repeatedly takes 
+		a face with a non empty outside set, adds its farthest point, 
+		replaces the faces visible from that point by a cone on the 
+		horizon and hands the outside sets of the removed faces to the
+		new faces, which takes one numpy signed distance computation. 
+		Points that are outside no face are dropped for good. The hull is
+		kept in a HalfEdges mesh.
+		"""
+		import numpy as np
+		
+		P = np.array([(v.v.x,v.v.y,v.v.z) for v in self.vertices], dtype=np.float64).reshape(-1,3)
+		if len(P) < 4:
+			raise DegenerateHull("Quickhull:  Need at least 4 points!")
+		epsilon = 1e-10 * np.max(np.abs(P))
+		mesh = HalfEdges(P.tolist())
+		
+		# the initial tetrahedron: the farthest pair of axis extremes, the point
+		# farthest from their line and the point farthest from that plane
+		lo, hi = np.argmin(P, axis=0), np.argmax(P, axis=0)
+		span = P[hi,(0,1,2)] - P[lo,(0,1,2)]
+		a, b = lo[np.argmax(span)], hi[np.argmax(span)]
+		ab = P[b] - P[a]
+		d = np.cross(P - P[a], ab)
+		c = np.argmax(np.einsum('ij,ij->i', d, d))
+		if not np.max(span) > epsilon or not np.linalg.norm(d[c]) > epsilon * np.linalg.norm(ab):
+			raise DegenerateHull("Quickhull:  All points are Collinear!")
+		n = np.cross(ab, P[c] - P[a])
+		d = np.argmax(np.abs((P - P[a]) @ n))
+		if not abs((P[d] - P[a]) @ n) > epsilon * np.linalg.norm(n):
+			raise DegenerateHull("Quickhull:  All points are coplanar!")
+		tetrahedron = (int(a),int(b),int(c),int(d))
+		
+		outside = {} # face -> indices of the points outside it
+		stack = [] # faces that got an outside set
+		def assign(points,faces):
+			N = np.array([(mesh.nx[f],mesh.ny[f],mesh.nz[f]) for f in faces])
+			D = P[points] @ N.T - np.array([mesh.offset[f] for f in faces])
+			best = np.argmax(D, axis=1)
+			keep = D[np.arange(len(points)),best] > epsilon
+			points, best = points[keep], best[keep]
+			order = np.argsort(best, kind='stable')
+			points = points[order]
+			end = np.cumsum(np.bincount(best, minlength=len(faces))).tolist()
+			start = 0
+			for f, e in zip(faces, end):
+				if e > start:
+					outside[f] = points[start:e]
+					stack.append(f)
+				start = e
+		
+		faces = mesh.Tetrahedron(*tetrahedron)
+		rest = np.setdiff1d(np.arange(len(P)), tetrahedron)
+		if len(rest):
+			assign(rest, faces)
+		
+		while stack:
+			f = stack.pop()
+			if f not in outside: # deleted since it was pushed
+				continue
+			points = outside.pop(f)
+			eye = int(points[np.argmax(P[points] @ (mesh.nx[f],mesh.ny[f],mesh.nz[f]))])
+			visible, new = mesh.AddCone( f, eye, epsilon )
+			pool = [points] + [outside.pop(g) for g in visible if g in outside]
+			pool = np.concatenate(pool)
+			pool = pool[pool != eye]
+			if len(pool):
+				assign(pool, new)
+		
+		# the faces of the other engines are oriented inward
+		self.Materialize([(u,w,v) for u,v,w in mesh.Triangles()])
+		
 	def AddOne(self,p):
 		"""
 		AddOne is passed a vertex.  It first determines all faces visible from 
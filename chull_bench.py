@@ -0,0 +1,81 @@
+# chull_bench.py, benchmark the convex hull engines in chull.py
+#
+# Every engine (and optionally every engine with interior culling) is run
+# on the same points for a range of sizes and distributions:
+#
+# sphere	points on the unit sphere, every point is on the hull (worst case)
+# cube		points on the surface of the unit cube, large flat parts
+# gaussian	normally distributed points, few of them on the hull
+#
+# python3 chull_bench.py --sizes 1000 10000 --engines randomized quickhull
+# python3 chull_bench.py --cull --output run.json
+# python3 chull_bench.py --engines quickhull --sizes 1000000 --processes 8
+
+import argparse
+import json
+import sys
+from time import perf_counter
+
+import numpy as np
+
+from chull import Vector, Hull
+
+def sphere(rng, n):
+	p = rng.normal(size=(n, 3))
+	return p / np.linalg.norm(p, axis=1)[:, None]
+
+def cube(rng, n):
+	p = rng.random((n, 3))
+	p[np.arange(n), rng.integers(3, size=n)] = rng.integers(2, size=n)
+	return p
+
+def gaussian(rng, n):
+	return rng.normal(size=(n, 3))
+
+distributions = {'sphere':sphere, 'cube':cube, 'gaussian':gaussian}
+
+engines = ('incremental', 'randomized', 'quickhull')
+
+def run(engine, points, cull=False, processes=None):
+	start = perf_counter()
+	hull = Hull(points, engine=engine, cull=cull, processes=processes)
+	elapsed = perf_counter() - start
+	return {
+		'engine':engine,
+		'cull':cull,
+		'time':elapsed,
+		'vertices':len(hull.vertices),
+		'faces':len(hull.faces),
+	}
+
+def suite(sizes, distnames, enginenames, cull=False, repeat=1, seed=42, processes=None):
+	results = []
+	for dist in distnames:
+		for size in sizes:
+			rng = np.random.default_rng(seed)
+			points = [Vector(*p) for p in distributions[dist](rng, size).tolist()]
+			for engine in enginenames:
+				for c in ((False, True) if cull else (False,)):
+					# keep the fastest of several runs
+					best = min((run(engine, points, c, processes) for r in range(repeat)), key=lambda r: r['time'])
+					best.update(distribution=dist, size=size, processes=processes)
+					results.append(best)
+					print("{engine:12s} {cull!s:5s} {distribution:8s} {size:8d} {time:9.4f}s vertices {vertices:7d} faces {faces:7d}".format(**best), file=sys.stderr)
+	return results
+
+if __name__ == "__main__":
+	parser = argparse.ArgumentParser(description="benchmark convex hull engines")
+	parser.add_argument('--sizes', type=int, nargs='+', default=[1000, 3000], help="number of points")
+	parser.add_argument('--distributions', nargs='+', default=list(distributions), choices=list(distributions))
+	parser.add_argument('--engines', nargs='+', default=list(engines), choices=list(engines))
+	parser.add_argument('--cull', action='store_true', help="also run every engine with interior culling")
+	parser.add_argument('--processes', type=int, help="calculate the hulls of this many chunks in parallel first")
+	parser.add_argument('--repeat', type=int, default=1, help="runs per combination, the fastest is reported")
+	parser.add_argument('--seed', type=int, default=42)
+	parser.add_argument('--output', help="write results as json to this file")
+	args = parser.parse_args()
+
+	results = suite(args.sizes, args.distributions, args.engines, args.cull, args.repeat, args.seed, args.processes)
+	if args.output:
+		with open(args.output, 'w') as f:
+			json.dump(results, f, indent=1)
@@ -1,48 +1,273 @@
-from random import random,seed, shuffle
-from time import time
-import mathutils
-from mathutils import Vector
+# kdtree_bench.py, benchmark nearest neighbor searches
+#
+# Compares the pure Python kd-tree in kdtree_native.py (built by repeated
+# insert() calls or in bulk with from_points()), the uniform grid and the
+# Z-order index in search.py, brute force NumPy and, when run inside
+# Blender, mathutils.kdtree over a range of tree sizes, query counts and
+# point distributions.
+#
+# python kdtree_bench.py --sizes 1000 10000 --queries 1000 --output run.json
+# python kdtree_bench.py --large --no-memory
+# python kdtree_bench.py --output new.json --compare run.json
+#
+# python kdtree_bench.py --all-nearest --sizes 20000 200000
+#
+# With --all-nearest Tree.all_nearest() is timed instead, next to
+# nearest_many() with the points themselves as queries (each finds itself,
+# so this is the cheapest possible query) and with as many fresh queries
+# from the same distribution, which is the cost all_nearest() should match.
+#
+# With --compare every result is matched with the same engine, distribution
+# and sizes in the baseline and flagged if its build or query time grew by
+# more than the tolerance. The exit status is 1 if anything regressed.
+
+import argparse
+import json
+import os
+import sys
+import tracemalloc
+from time import perf_counter
+
+import numpy as np
 
 from kdtree_native import Tree
 
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import search
+
+try:
+	import mathutils
+	from mathutils import kdtree
+except ImportError:
+	mathutils = None
+
+def uniform(rng, n):
+	return rng.random((n, 3))
+
+def clustered(rng, n, clusters=20, sigma=0.02):
+	centers = rng.random((clusters, 3))
+	return centers[rng.integers(clusters, size=n)] + rng.normal(scale=sigma, size=(n, 3))
 
-def bench_kdtree_blender(tsize, qsize):
+def planar(rng, n):
+	p = rng.random((n, 3))
+	p[:, 2] = 0.5
+	return p
 
-	pos=[Vector((random(),random(),random())) for p in range(tsize)]
-	qpos=[Vector((random(),random(),random())) for p in range(qsize)]
+def collinear(rng, n):
+	return np.outer(rng.random(n), (1.0, 0.5, 0.25))
 
-	start = time()
-	kd = mathutils.kdtree.KDTree(tsize)
-	for i,p in enumerate(pos):
+distributions = {'uniform':uniform, 'clustered':clustered, 'planar':planar, 'collinear':collinear}
+
+# every engine takes the points and queries as (n,3) arrays and returns
+# the index of the nearest point for each query, the build time, the query
+# time and the number of nodes visited (None if the engine does not count)
+
+def bench_native_insert(points, queries):
+	start = perf_counter()
+	kd = Tree(3)
+	for i, p in enumerate(points):
 		kd.insert(p, i)
-	kd.balance()
-	buildtime = time()-start
-	start = time()
-	for p in qpos:
-		(co, index, dist) = kd.find(p)
-	querytime = time()-start
-	return buildtime, querytime
+	buildtime = perf_counter() - start
+	start = perf_counter()
+	result = [kd.nearest(p)[0].data for p in queries]
+	querytime = perf_counter() - start
+	return result, buildtime, querytime, kd.count
+
+def bench_native_array(points, queries):
+	start = perf_counter()
+	kd = Tree.from_points(points)
+	buildtime = perf_counter() - start
+	start = perf_counter()
+	result = [kd.nearest(p)[0].data for p in queries]
+	querytime = perf_counter() - start
+	return result, buildtime, querytime, kd.count
 
-def bench_kdtree_pure(tsize, qsize):
+def bench_native_many(points, queries):
+	start = perf_counter()
+	kd = Tree.from_points(points)
+	buildtime = perf_counter() - start
+	start = perf_counter()
+	result, distsq = kd.nearest_many(queries)
+	querytime = perf_counter() - start
+	return result, buildtime, querytime, kd.count
 
-	pos=[Vector((random(),random(),random())) for p in range(tsize)]
-	qpos=[Vector((random(),random(),random())) for p in range(qsize)]
+def bench_grid(points, queries):
+	N = max(1, int(round(len(points) ** (1/3))))
+	start = perf_counter()
+	order, occupied, offsets, lo, w = search.grid(points, N)
+	buildtime = perf_counter() - start
+	start = perf_counter()
+	result, dist = search.search_many(queries, points, order, occupied, offsets, lo, w, N)
+	querytime = perf_counter() - start
+	return result, buildtime, querytime, None
 
-	start = time()
-	kd = Tree(tsize)
-	for i,p in enumerate(pos):
+def bench_morton(points, queries):
+	start = perf_counter()
+	index = search.morton(points)
+	buildtime = perf_counter() - start
+	start = perf_counter()
+	result = search.morton_knn_many(queries, 1, points, *index)[0][:,0]
+	querytime = perf_counter() - start
+	return result, buildtime, querytime, None
+
+def bench_brute(points, queries, chunksize=256):
+	start = perf_counter()
+	result = np.empty(len(queries), dtype=np.int64)
+	for b in range(0, len(queries), chunksize):
+		q = queries[b:b + chunksize]
+		d = np.einsum('ij,ij->i', points, points)[None, :] - 2 * q @ points.T
+		result[b:b + chunksize] = np.argmin(d, axis=1)
+	querytime = perf_counter() - start
+	return result, 0.0, querytime, len(points) * len(queries)
+
+def bench_mathutils(points, queries):
+	pos = [mathutils.Vector(p) for p in points]
+	qpos = [mathutils.Vector(p) for p in queries]
+	start = perf_counter()
+	kd = kdtree.KDTree(len(pos))
+	for i, p in enumerate(pos):
 		kd.insert(p, i)
-	#kd.balance()
-	buildtime = time()-start
-	start = time()
-	for p in qpos:
-		(co, dist) = kd.nearest(p)
-	querytime = time()-start
-	return buildtime, querytime
+	kd.balance()
+	buildtime = perf_counter() - start
+	start = perf_counter()
+	result = [kd.find(p)[1] for p in qpos]
+	querytime = perf_counter() - start
+	return result, buildtime, querytime, None
+
+engines = {
+	'native-insert':bench_native_insert,
+	'native-array':bench_native_array,
+	'native-many':bench_native_many,
+	'grid':bench_grid,
+	'morton':bench_morton,
+	'brute':bench_brute,
+}
+if mathutils is not None:
+	engines['mathutils'] = bench_mathutils
+
+def peak_memory(engine, points, queries):
+	"""return the peak traced memory of a separate run, tracing slows engines down by very different amounts"""
+	tracemalloc.start()
+	try:
+		engines[engine](points, queries)
+		_, peak = tracemalloc.get_traced_memory()
+	finally:
+		tracemalloc.stop()
+	return peak
+
+def run(engine, points, queries, reference):
+	result, buildtime, querytime, visited = engines[engine](points, queries)
+	# ties may legitimately resolve to another index, so compare distances
+	d = np.einsum('ij,ij->i', points[np.asarray(result)] - queries, points[np.asarray(result)] - queries)
+	return {
+		'engine':engine,
+		'build':buildtime,
+		'query':querytime,
+		'visited':visited,
+		'mismatches':int(np.count_nonzero(d > reference + 1e-12)),
+	}
+
+def suite(sizes, querycounts, distnames, enginenames, repeat=1, seed=42, memory=True):
+	results = []
+	for dist in distnames:
+		for tsize in sizes:
+			for qsize in querycounts:
+				rng = np.random.default_rng(seed)
+				points = distributions[dist](rng, tsize)
+				queries = distributions[dist](rng, qsize)
+				diff = points[bench_brute(points, queries)[0]] - queries
+				reference = np.einsum('ij,ij->i', diff, diff)
+				for engine in enginenames:
+					# keep the fastest of several runs, the memory peak does not vary
+					runs = [run(engine, points, queries, reference) for r in range(repeat)]
+					best = min(runs, key=lambda r: r['build'] + r['query'])
+					best.update(distribution=dist, size=tsize, queries=qsize,
+						peak_memory=peak_memory(engine, points, queries) if memory else None)
+					results.append(best)
+					print("{engine:14s} {distribution:10s} {size:8d} {queries:8d} build {build:9.4f}s query {query:9.4f}s mem {mem:>11s} mismatches {mismatches:d}".format(
+						mem=str(best['peak_memory']), **best), file=sys.stderr)
+	return results
+
+def all_nearest_suite(sizes, distnames, seed=42):
+	"""time all_nearest() against nearest_many() on the same tree and check it with brute force where that fits"""
+	results = []
+	for dist in distnames:
+		for size in sizes:
+			rng = np.random.default_rng(seed)
+			# one draw so the fresh queries come from the same clusters
+			points, queries = np.split(distributions[dist](rng, 2 * size), 2)
+			kd = Tree.from_points(points)
+			start = perf_counter()
+			indices, distsq = kd.all_nearest()
+			alltime = perf_counter() - start
+			start = perf_counter()
+			kd.nearest_many(points)
+			selftime = perf_counter() - start
+			start = perf_counter()
+			kd.nearest_many(queries)
+			querytime = perf_counter() - start
+			mismatches = None
+			if size <= 20000:
+				mismatches = 0
+				for b in range(0, size, 256):
+					d = np.einsum('ij,ij->i', points, points)[None, :] - 2 * points[b:b + 256] @ points.T + np.einsum('ij,ij->i', points[b:b + 256], points[b:b + 256])[:, None]
+					d[np.arange(len(d)), np.arange(b, b + len(d))] = np.inf
+					mismatches += int(np.count_nonzero(distsq[b:b + 256] > d.min(axis=1) + 1e-9))
+			results.append({'engine':'all-nearest', 'distribution':dist, 'size':size, 'queries':size,
+				'build':0.0, 'query':alltime, 'self':selftime, 'fresh':querytime, 'mismatches':mismatches})
+			print("all-nearest    {:10s} {:8d} all_nearest {:9.4f}s nearest_many self {:9.4f}s fresh {:9.4f}s mismatches {}".format(
+				dist, size, alltime, selftime, querytime, mismatches), file=sys.stderr)
+	return results
+
+def key(r):
+	return r['engine'], r['distribution'], r['size'], r['queries']
 
+def compare(results, baseline, tolerance):
+	"""return a list of regression messages for results slower than the baseline by more than tolerance"""
+	old = {key(r):r for r in baseline}
+	regressions = []
+	for r in results:
+		b = old.get(key(r))
+		if b is None:
+			continue
+		for metric in ('build', 'query'):
+			# ignore timings too short to be measured reliably
+			if r[metric] > b[metric] * (1 + tolerance) and r[metric] > 1e-3:
+				regressions.append("{} {} size {} queries {}: {} {:.4f}s -> {:.4f}s".format(*key(r), metric, b[metric], r[metric]))
+	return regressions
 
-tsize, qsize = 1000,10000
+if __name__ == "__main__":
+	parser = argparse.ArgumentParser(description="benchmark nearest neighbor search")
+	parser.add_argument('--sizes', type=int, nargs='+', default=[1000, 10000], help="number of points in the tree")
+	parser.add_argument('--queries', type=int, nargs='+', default=[1000], help="number of query points")
+	parser.add_argument('--large', action='store_true', help="add 100000 points and 10000 queries to the sizes, this takes a long time")
+	parser.add_argument('--no-memory', dest='memory', action='store_false', help="skip the extra traced run that measures peak memory")
+	parser.add_argument('--distributions', nargs='+', default=list(distributions), choices=list(distributions))
+	parser.add_argument('--engines', nargs='+', default=list(engines), choices=list(engines))
+	parser.add_argument('--all-nearest', dest='allnearest', action='store_true', help="time Tree.all_nearest() against nearest_many() instead")
+	parser.add_argument('--repeat', type=int, default=1, help="runs per combination, the fastest is reported")
+	parser.add_argument('--seed', type=int, default=42)
+	parser.add_argument('--output', help="write results as json to this file (default stdout)")
+	parser.add_argument('--compare', metavar='BASELINE', help="json file with earlier results to check for regressions")
+	parser.add_argument('--tolerance', type=float, default=0.2, help="allowed relative slowdown before a result counts as a regression")
+	args = parser.parse_args()
 
-print(bench_kdtree_blender(tsize, qsize))
-print(bench_kdtree_pure(tsize, qsize))
+	if args.large:
+		args.sizes = sorted(set(args.sizes) | {100000})
+		args.queries = sorted(set(args.queries) | {10000})
+	if args.allnearest:
+		results = all_nearest_suite(args.sizes, args.distributions, args.seed)
+	else:
+		results = suite(args.sizes, args.queries, args.distributions, args.engines, args.repeat, args.seed, args.memory)
+	if args.output:
+		with open(args.output, 'w') as f:
+			json.dump(results, f, indent=1)
+	else:
+		json.dump(results, sys.stdout, indent=1)
 
+	if args.compare:
+		with open(args.compare) as f:
+			regressions = compare(results, json.load(f), args.tolerance)
+		for r in regressions:
+			print("REGRESSION", r, file=sys.stderr)
+		sys.exit(1 if regressions else 0)
@@ -23,6 +23,12 @@
 # ##### END GPL LICENSE BLOCK #####
 
 from copy import copy, deepcopy
+from math import log, sqrt
+from heapq import heappush, heapreplace
+from multiprocessing import Pool, shared_memory
+import json
+import struct
+import numpy as np
 
 class Hyperrectangle:
 	'''an axis aligned bounding box of arbitrary dimension'''
@@ -63,6 +69,9 @@ class Node:
 		self.dir = 0
 		self.count=0
 		self.level=0
+		self.size=1 # number of nodes in this subtree, removed ones included
+		self.deleted=False
+		self.serial=0 # insertion number, breaks ties between equal points
 		self.rect=Hyperrectangle(self.dim,pos,pos)
 
 	def addleft(self, node):
@@ -88,44 +97,408 @@ class Node:
 	def __str__(self):
 		return self._str(0)
 
+def box_distance_squared(bbmin, bbmax, pos):
+	'''array version of Hyperrectangle.distance_squared for boxes stored as rows of flat arrays'''
+	d = np.maximum(bbmin - pos, 0.0) + np.maximum(pos - bbmax, 0.0)
+	return np.einsum('...i,...i', d, d)
+
+def box_box_distance_squared(amin, amax, bmin, bmax):
+	'''return the squared distance between the nearest edges of two sets of boxes, zero where they overlap'''
+	d = np.maximum(bmin - amax, 0.0) + np.maximum(amin - bmax, 0.0)
+	return np.einsum('...i,...i', d, d)
+
 class Tree:
 	"""implements a kd-tree"""
+
+	# the flat arrays of an array backed tree, see from_points()
+	arrays = ('points', 'index', 'split_axis', 'split_value', 'left', 'right', 'start', 'end', 'bbmin', 'bbmax', '_leaves')
+
+	magic = b'KDTREE\r\n' # the \r\n catches files mangled by newline conversion
+	fileversion = 1
 	
 	def __init__(self, dim):
+		self.dim = dim
 		self.root = None
 		self.nnearest=0 # number of nearest neighbor queries
 		self.count=0  # number of nodes visited
 		self.level=0 # deepest node level 
+		self.maxerror=0.0 # largest relative distance error that approximate queries may have made
+		self.lasterror=0.0 # same, for the last query only
+		self._approximate(0.0, None)
+		self.alpha=0.7 # a subtree is rebuilt if one child holds more than this fraction of its nodes
+		self.size=0 # number of nodes, removed ones included
+		self.live=0 # number of nodes not removed
+		self.serial=0 # number of nodes ever inserted
+		self._nodes={} # data -> live nodes holding it, see remove()
+		self.points = None # array backed storage, see from_points()
+		self._leaves = None
+
+	@classmethod
+	def from_points(cls, points, data=None, leafsize=8):
+		"""
+		Return a balanced tree built from an (n, dim) array of points.
+
+		Instead of Node objects the tree is stored in flat arrays, one row
+		per node in heap order (the children of node i are 2i+1 and 2i+2):
+		split_axis (-1 for a leaf), split_value, left, right, the range
+		start:end of points covered by the node and its bounding box
+		bbmin, bbmax. Each level is split at the median along the widest
+		axis of the bounding box so every leaf ends up at the same depth and
+		holds at most leafsize points. The points are stored reordered,
+		index maps them back to their position in the original array.
+
+		If data is given, data[i] is returned as node.data for point i,
+		otherwise the original index i is used (like mathutils.kdtree).
+		An array backed tree has no empty nodes, checkempty is ignored.
+		"""
+		points = np.array(points, dtype=np.float64)
+		if points.ndim != 2:
+			raise ValueError("points should be an (n, dim) array")
+		n, dim = points.shape
+		leafsize = max(2, int(leafsize))
+		depth = 0
+		while n and -(-n >> depth) > leafsize: depth += 1
+		nnodes = (2 << depth) - 1 if n else 0
+
+		tree = cls(dim)
+		tree.leafsize = leafsize
+		tree.split_axis = np.full(nnodes, -1, dtype=np.int32)
+		tree.split_value = np.zeros(nnodes, dtype=np.float64)
+		tree.left = np.full(nnodes, -1, dtype=np.int32)
+		tree.right = np.full(nnodes, -1, dtype=np.int32)
+		tree.start = np.zeros(nnodes, dtype=np.int64)
+		tree.end = np.zeros(nnodes, dtype=np.int64)
+		tree.bbmin = np.zeros((nnodes, dim), dtype=np.float64)
+		tree.bbmax = np.zeros((nnodes, dim), dtype=np.float64)
+
+		# one permutation per axis, each grouped by node and sorted along its axis within a node
+		orders = np.array([np.argsort(points[:, k], kind='stable') for k in range(dim)]).reshape(dim, n)
+		positions = np.arange(n)
+		if n:
+			tree.end[0] = n
+		for level in range(depth + 1 if n else 0):
+			first = (1 << level) - 1
+			last = 2 * first + 1
+			s = tree.start[first:last]
+			e = tree.end[first:last]
+			p = points[orders[0]]
+			# all ranges are non empty and consecutive so reduceat yields the bounding boxes
+			tree.bbmin[first:last] = np.minimum.reduceat(p, s, axis=0)
+			tree.bbmax[first:last] = np.maximum.reduceat(p, s, axis=0)
+			if level == depth:
+				break
+			axis = np.argmax(tree.bbmax[first:last] - tree.bbmin[first:last], axis=1)
+			mid = (s + e) // 2
+			nodes = np.arange(first, last)
+			tree.split_axis[first:last] = axis
+			tree.split_value[first:last] = points[orders[axis, mid], axis]
+			tree.left[first:last] = 2 * nodes + 1
+			tree.right[first:last] = 2 * nodes + 2
+			tree.start[2 * nodes + 1], tree.end[2 * nodes + 1] = s, mid
+			tree.start[2 * nodes + 2], tree.end[2 * nodes + 2] = mid, e
+
+			# the lower half along the split axis goes left ...
+			seg = np.repeat(np.arange(last - first), e - s)
+			posaxis = axis[seg]
+			inleft = positions < mid[seg]
+			goesleft = np.empty(n, dtype=bool)
+			for k in range(dim):
+				sel = posaxis == k
+				goesleft[orders[k][sel]] = inleft[sel]
+			# ... and a stable partition of every permutation keeps them sorted per child
+			for k in range(dim):
+				f = goesleft[orders[k]]
+				cl = np.cumsum(f)
+				cr = positions + 1 - cl
+				lbase = (cl[s] - f[s])[seg]
+				rbase = (cr[s] - ~f[s])[seg]
+				newpos = np.where(f, s[seg] + cl - 1 - lbase, mid[seg] + cr - 1 - rbase)
+				neworder = np.empty_like(orders[k])
+				neworder[newpos] = orders[k]
+				orders[k] = neworder
+
+		order = orders[0]
+		tree.points = points[order]
+		tree.index = order
+		tree.data = data
+		tree.level = depth
+		return tree
+
+	def save(self, path):
+		"""
+		Write an array backed tree to a binary file.
+
+		The file starts with magic, a little endian uint32 file version and
+		the uint32 length of a json header that lists dim, level, leafsize
+		and for every array its dtype, shape and byte offset. The arrays
+		follow, each aligned to 64 bytes so they can be mapped directly.
+		data is stored too if it is a sequence of numbers.
+		"""
+		if self.points is None:
+			raise ValueError("only array backed trees can be saved, see from_points()")
+		if self._leaves is None:
+			self._leaves = self._leaftable() if len(self.points) else np.zeros((0, 1), dtype=np.int64)
+		arrays = {attr: getattr(self, attr) for attr in self.arrays}
+		if self.data is not None:
+			data = np.asarray(self.data)
+			if data.dtype.kind not in 'biuf':
+				raise ValueError("only numeric data can be saved")
+			arrays['data'] = data
+		arrays = {name: np.ascontiguousarray(a, dtype=a.dtype.newbyteorder('<')) for name, a in arrays.items()}
+
+		header = {'dim':self.dim, 'level':self.level, 'leafsize':self.leafsize, 'arrays':{}}
+		# the offsets depend on the header length, so lay out the arrays with room to spare
+		prefix = len(self.magic) + 8
+		headerlength = len(json.dumps(dict(header, arrays={name:[a.dtype.str, a.shape, 2**63] for name, a in arrays.items()})))
+		offset = prefix + headerlength
+		for name, a in arrays.items():
+			offset = (offset + 63) // 64 * 64
+			header['arrays'][name] = [a.dtype.str, a.shape, offset]
+			offset += a.nbytes
+		headerbytes = json.dumps(header).encode('ascii')
+
+		with open(path, 'wb') as f:
+			f.write(self.magic)
+			f.write(struct.pack('<II', self.fileversion, len(headerbytes)))
+			f.write(headerbytes)
+			for name, a in arrays.items():
+				f.seek(header['arrays'][name][2])
+				f.write(a.tobytes())
+			f.truncate(offset)
+
+	@classmethod
+	def open(cls, path, mmap=True):
+		"""
+		Return an array backed tree read from a file written by save().
+
+		With mmap the arrays are read-only views on a memory map of the
+		file, so nothing is read until queries touch it and several
+		processes opening the same file share its pages. Otherwise the
+		arrays are read into memory.
+		"""
+		with open(path, 'rb') as f:
+			if f.read(len(cls.magic)) != cls.magic:
+				raise ValueError("%s is not a kd-tree file"%path)
+			version, headerlength = struct.unpack('<II', f.read(8))
+			if version != cls.fileversion:
+				raise ValueError("%s has file version %d, expected %d"%(path, version, cls.fileversion))
+			header = json.loads(f.read(headerlength).decode('ascii'))
+			tree = cls(header['dim'])
+			tree.level = header['level']
+			tree.leafsize = header['leafsize']
+			tree.data = None
+			for name, (dtype, shape, offset) in header['arrays'].items():
+				count = int(np.prod(shape))
+				if mmap and count:
+					a = np.memmap(path, dtype=dtype, mode='r', offset=offset, shape=tuple(shape))
+				else:
+					f.seek(offset)
+					a = np.fromfile(f, dtype=dtype, count=count).reshape(shape)
+				setattr(tree, name, a)
+		return tree
+
+	def _arraynode(self, i):
+		'''return a Node for the point stored at position i of an array backed tree'''
+		index = int(self.index[i])
+		return Node(self.points[i], index if self.data is None else self.data[index])
 	
 	def resetcounters(self):
 		self.nnearest=0 # number of nearest neighbor queries
 		self.count=0  # number of nodes visited
-		
-	def _insert(self, node, pos, data):
-		if pos[node.dir] < node.pos[node.dir]:
-			if node.left is None:
-				node.addleft(Node(pos, data))
-				return node.left
-			else:
-				node.rect.extend(pos)
-				return self._insert(node.left, pos, data)
+		self.maxerror=0.0
+		self.lasterror=0.0
+
+	def _approximate(self, epsilon, max_visits):
+		'''set up the pruning factor and visit budget of the next query'''
+		self._shrink = 1.0/(1.0+epsilon)**2
+		self._maxcount = float('inf') if max_visits is None else self.count + max_visits
+		self._lowerbound = float('inf') # nearest bounding box that was skipped
+
+	def _skip(self, rectdistsq):
+		if rectdistsq < self._lowerbound:
+			self._lowerbound = rectdistsq
+
+	def _error(self, distsq):
+		'''record how much further away distsq may be than the true answer, given the subtrees skipped'''
+		if distsq is None or self._lowerbound >= distsq:
+			self.lasterror = 0.0
+		elif self._lowerbound <= 0.0:
+			self.lasterror = float('inf')
 		else:
-			if node.right is None:
-				node.addright(Node(pos, data))
-				return node.right
-			else:
-				node.rect.extend(pos)
-				return self._insert(node.right, pos, data)
+			self.lasterror = sqrt(distsq/self._lowerbound) - 1.0
+		if self.lasterror > self.maxerror:
+			self.maxerror = self.lasterror
+		
+	def __len__(self):
+		return len(self.points) if self.points is not None else self.live
+
+	@staticmethod
+	def _key(pos, dir, serial):
+		'''the coordinates starting at dir and then the serial number, so no two nodes compare equal'''
+		return tuple(pos[dir:]) + tuple(pos[:dir]) + (serial,)
+
+	def _isleft(self, pos, serial, node):
+		'''return True if a point at pos with this serial number belongs in the left subtree of node'''
+		a, b = pos[node.dir], node.pos[node.dir]
+		if a != b:
+			return a < b
+		return self._key(pos, node.dir, serial) < self._key(node.pos, node.dir, node.serial)
+
+	def _build(self, nodes, dir, level):
+		'''link a list of existing nodes into a balanced subtree and return its root'''
+		if not nodes:
+			return None
+		# ties are broken on the other coordinates and the serial number,
+		# so even many equal points end up in a balanced subtree
+		nodes.sort(key=lambda n: self._key(n.pos, dir, n.serial))
+		m = len(nodes)//2
+		node = nodes[m]
+		node.dir = dir
+		node.level = level
+		node.left = self._build(nodes[:m], (dir+1)%node.dim, level+1)
+		node.right = self._build(nodes[m+1:], (dir+1)%node.dim, level+1)
+		node.rect = Hyperrectangle(node.dim, node.pos, node.pos)
+		node.size = 1
+		for child in (node.left, node.right):
+			if child is not None:
+				node.rect.extend(child.rect.min)
+				node.rect.extend(child.rect.max)
+				node.size += child.size
+		return node
+
+	def _rebuild(self, node):
+		'''rebuild the subtree rooted at node without its removed nodes and return the new root'''
+		nodes = []
+		stack = [node]
+		while stack:
+			n = stack.pop()
+			if n is not None:
+				if not n.deleted:
+					nodes.append(n)
+				stack.append(n.left)
+				stack.append(n.right)
+		self.size -= node.size - len(nodes)
+		return self._build(nodes, node.dir, node.level)
 
 	def insert(self, pos, data):
+		"""
+		Insert a new node and return it.
+
+		This is a scapegoat tree: if the new node ends up deeper than
+		log(size)/log(1/alpha), the lowest ancestor with a child holding
+		more than alpha of its nodes is rebuilt as a balanced subtree, so
+		the depth stays bounded at an amortized cost of O(log n).
+		"""
+		if self.points is not None:
+			raise ValueError("array backed trees are static")
+		self.size += 1
+		self.live += 1
+		serial = self.serial
+		self.serial += 1
 		if self.root is None:
 			self.root = Node(pos,data)
+			self.root.serial = serial
 			self.level = self.root.level
+			self._index(self.root)
 			return self.root
+
+		path = []
+		node = self.root
+		while node is not None:
+			path.append(node)
+			node.size += 1
+			node.rect.extend(pos)
+			node = node.left if self._isleft(pos, serial, node) else node.right
+		node = Node(pos, data)
+		node.serial = serial
+		self._index(node)
+		parent = path[-1]
+		if self._isleft(pos, serial, parent):
+			parent.addleft(node)
 		else:
-			node=self._insert(self.root, pos, data)
-			if node.level > self.level : self.level = node.level
-			return node
+			parent.addright(node)
+		if node.level > self.level : self.level = node.level
+
+		if node.level > log(self.size)/log(1/self.alpha):
+			child = node
+			for i in range(len(path)-1, -1, -1):
+				scapegoat = path[i]
+				if child.size > self.alpha * scapegoat.size:
+					break
+				child = scapegoat
+			removed = scapegoat.size
+			subtree = self._rebuild(scapegoat)
+			removed -= 0 if subtree is None else subtree.size
+			for ancestor in path[:i]:
+				ancestor.size -= removed
+			if i == 0:
+				self.root = subtree
+			elif path[i-1].left is scapegoat:
+				path[i-1].left = subtree
+			else:
+				path[i-1].right = subtree
+		return node
+
+	def _index(self, node):
+		try:
+			self._nodes.setdefault(node.data, []).append(node)
+		except TypeError: # unhashable data is found by checking every node
+			pass
+
+	def _find(self, data, pos):
+		try:
+			candidates = self._nodes.get(data, ())
+		except TypeError:
+			candidates = None
+		if candidates is not None:
+			for node in candidates:
+				if pos is None or node.distance_squared(pos) == 0:
+					return node
+			return None
+		stack = [self.root]
+		while stack:
+			node = stack.pop()
+			if node is not None:
+				if not node.deleted and (node.data is data or node.data == data) and (pos is None or node.distance_squared(pos) == 0):
+					return node
+				stack.append(node.left)
+				stack.append(node.right)
+		return None
+
+	def remove(self, data, pos=None):
+		"""
+		Remove the node holding data and return it, or None if not found.
+
+		Nodes are found through a dictionary keyed by data, if pos is
+		given only a node at pos matches. Nodes with unhashable data are
+		found by checking every node. Removed nodes are skipped by all
+		queries and dropped for real when the subtree they are in is
+		rebuilt; once they make up more than 1-alpha of all nodes the
+		whole tree is rebuilt.
+		"""
+		if self.points is not None:
+			raise ValueError("array backed trees are static")
+		node = self._find(data, pos)
+		if node is None:
+			return None
+		node.deleted = True
+		self.live -= 1
+		try:
+			nodes = self._nodes[node.data]
+			nodes.remove(node)
+			if not nodes:
+				del self._nodes[node.data]
+		except TypeError:
+			pass
+		if self.live < self.alpha * self.size:
+			self.root = self._rebuild(self.root)
+			self.level = self._depth(self.root)
+		return node
+
+	def _depth(self, node):
+		if node is None:
+			return 0
+		return max(node.level, self._depth(node.left), self._depth(node.right))
 
 	def _nearest(self, node, pos, checkempty, level=0):
 		
@@ -136,7 +509,7 @@ class Tree:
 		
 		result = node
 		distsq = None
-		if checkempty and (node.data is None):
+		if node.deleted or (checkempty and (node.data is None)):
 			result = None
 		else:
 			distsq = node.distance_squared(pos)
@@ -149,30 +522,478 @@ class Tree:
 			fartree = node.left
 
 		if neartree is not None:
-			nearnode, neardistsq = self._nearest(neartree,pos,checkempty,level+1)
-			if (result is None) or (neardistsq is not None and neardistsq < distsq):
-				result, distsq = nearnode, neardistsq
+			if (result is None) or self.count < self._maxcount:
+				nearnode, neardistsq = self._nearest(neartree,pos,checkempty,level+1)
+				if (result is None) or (neardistsq is not None and neardistsq < distsq):
+					result, distsq = nearnode, neardistsq
+			else:
+				self._skip(neartree.rect.distance_squared(pos))
 		
 		if fartree is not None:
-			if (result is None) or (fartree.rect.distance_squared(pos) < distsq):
+			rectdistsq = None if result is None else fartree.rect.distance_squared(pos)
+			if (result is None) or (rectdistsq < distsq * self._shrink and self.count < self._maxcount):
 				farnode, fardistsq = self._nearest(fartree,pos,checkempty,level+1)
 				if (result is None) or (fardistsq is not None and fardistsq < distsq):
 					result, distsq = farnode, fardistsq
+			elif rectdistsq < distsq:
+				self._skip(rectdistsq)
 			
 		return result, distsq
 
-	def nearest(self, pos, checkempty=False):
+	def _nearest_array(self, node, pos, best, bestdistsq):
+
+		self.count+=1
+
+		axis = self.split_axis[node]
+		if axis < 0:
+			s, e = self.start[node], self.end[node]
+			d = self.points[s:e] - pos
+			d = np.einsum('ij,ij->i', d, d)
+			i = np.argmin(d)
+			if bestdistsq is None or d[i] < bestdistsq:
+				best, bestdistsq = s + i, d[i]
+			return best, bestdistsq
+
+		if pos[axis] < self.split_value[node]:
+			neartree, fartree = self.left[node], self.right[node]
+		else:
+			neartree, fartree = self.right[node], self.left[node]
+
+		if bestdistsq is None or self.count < self._maxcount:
+			best, bestdistsq = self._nearest_array(neartree, pos, best, bestdistsq)
+		else:
+			self._skip(box_distance_squared(self.bbmin[neartree], self.bbmax[neartree], pos))
+		rectdistsq = box_distance_squared(self.bbmin[fartree], self.bbmax[fartree], pos)
+		if rectdistsq < bestdistsq * self._shrink and self.count < self._maxcount:
+			best, bestdistsq = self._nearest_array(fartree, pos, best, bestdistsq)
+		elif rectdistsq < bestdistsq:
+			self._skip(rectdistsq)
+		return best, bestdistsq
+
+	def nearest(self, pos, checkempty=False, epsilon=0.0, max_visits=None):
+		"""
+		Return the node nearest to pos and its squared distance.
+
+		With epsilon > 0 a subtree is skipped unless its bounding box is
+		closer than best/(1+epsilon)**2, so the answer is at most a factor
+		1+epsilon further away than the true nearest neighbor. max_visits
+		limits the number of nodes visited once a first candidate is
+		found. The error bound actually achieved, given the subtrees that
+		were skipped, is left in lasterror (and maxerror).
+		"""
 		self.nnearest+=1
+		self._approximate(epsilon, max_visits)
+		if self.points is not None:
+			if len(self.points) == 0:
+				return None, None
+			i, distsq = self._nearest_array(0, np.asarray(pos, dtype=np.float64), None, None)
+			self._error(distsq)
+			return self._arraynode(i), float(distsq)
 		if self.root is None:
 			return None, None
 		self.root.count=0
 		node, distsq = self._nearest(self.root, pos, checkempty)
 		self.count+=self.root.count
+		self._error(distsq)
 		return node,distsq
 		
+	def _slots(self, nodes):
+		'''return a (len(nodes), maxsize) array with the point positions of each node, padded with -1'''
+		s = self.start[nodes]
+		e = self.end[nodes]
+		table = s[:, None] + np.arange(np.max(e - s))
+		return np.where(table < e[:, None], table, -1)
+
+	def _leaftable(self):
+		'''return a (leaves, maxleafsize) array with the point positions of each leaf, padded with -1'''
+		return self._slots(np.arange((1 << self.level) - 1, len(self.split_axis)))
+
+	def _scanleaves(self, queries, qi, leaves, best, bestdistsq, exclude=None):
+		'''update best and bestdistsq for queries[qi] with the points in the corresponding leaves, skipping position exclude[qi]'''
+		slots = self._leaves[leaves - ((1 << self.level) - 1)]
+		d = self.points[slots] - queries[qi][:, None, :]
+		d = np.einsum('ijk,ijk->ij', d, d)
+		d[slots < 0] = np.inf
+		if exclude is not None:
+			d[slots == exclude[qi][:, None]] = np.inf
+		j = np.argmin(d, axis=1)
+		r = np.arange(len(qi))
+		candidate, candidatedistsq = slots[r, j], d[r, j]
+		# a query may have visited several leaves, keep only its closest candidate
+		o = np.lexsort((candidatedistsq, qi))
+		o = o[np.r_[True, qi[o][1:] != qi[o][:-1]]]
+		better = candidatedistsq[o] < bestdistsq[qi[o]]
+		o = o[better]
+		best[qi[o]] = candidate[o]
+		bestdistsq[qi[o]] = candidatedistsq[o]
+
+	def _nearest_block(self, queries, exclude=None):
+		n = len(queries)
+		r = np.arange(n)
+		best = np.full(n, -1, dtype=np.int64)
+		bestdistsq = np.full(n, np.inf)
+
+		# first descend every query to the leaf containing it to get an upper bound ...
+		home = np.zeros(n, dtype=np.int64)
+		for level in range(self.level):
+			axis = self.split_axis[home]
+			home = np.where(queries[r, axis] < self.split_value[home], self.left[home], self.right[home])
+		self._scanleaves(queries, r, home, best, bestdistsq, exclude)
+		self.count += n * (self.level + 1)
+
+		# ... then walk down level by level with all (query, node) pairs whose box may hold something closer
+		qi = r
+		node = np.zeros(n, dtype=np.int64)
+		for level in range(self.level + 1):
+			self.count += len(qi)
+			keep = box_distance_squared(self.bbmin[node], self.bbmax[node], queries[qi]) < bestdistsq[qi]
+			qi, node = qi[keep], node[keep]
+			if level < self.level:
+				qi = np.repeat(qi, 2)
+				node = np.stack((self.left[node], self.right[node]), axis=1).ravel()
+		keep = node != home[qi]
+		if np.any(keep):
+			self._scanleaves(queries, qi[keep], node[keep], best, bestdistsq, exclude)
+		return best, bestdistsq
+
+	def nearest_many(self, queries, blocksize=4096):
+		"""
+		Return (indices, distsq) arrays with for each row in queries the
+		original index of the nearest point and its squared distance.
+
+		Instead of a recursive descent per query, blocks of queries are
+		processed together: all (query, node) pairs that are not pruned
+		by their bounding box distance are carried down the tree one
+		level at a time with NumPy masks, and the leaf buckets they reach
+		are scanned at once. Needs an array backed tree (see from_points).
+		"""
+		if self.points is None:
+			raise ValueError("nearest_many() needs an array backed tree, see from_points()")
+		queries = np.asarray(queries, dtype=np.float64).reshape(-1, self.dim)
+		nq = len(queries)
+		self.nnearest += nq
+		indices = np.full(nq, -1, dtype=np.int64)
+		distsq = np.full(nq, np.inf)
+		if nq == 0 or len(self.points) == 0:
+			return indices, distsq
+		if getattr(self, '_leaves', None) is None:
+			self._leaves = self._leaftable()
+		for b in range(0, nq, blocksize):
+			best, bestdistsq = self._nearest_block(queries[b:b + blocksize])
+			indices[b:b + blocksize] = self.index[best]
+			distsq[b:b + blocksize] = bestdistsq
+		return indices, distsq
+
+	def all_nearest(self, blocksize=4096):
+		"""
+		Return (indices, distsq) arrays with for every point the original
+		index of the nearest other point and its squared distance, in the
+		original order of the points.
+
+		This is nearest_many() with the points themselves as queries, each
+		skipping its own position. The points are stored in tree order so
+		every block of queries is spatially compact and visits few nodes.
+		Needs an array backed tree.
+		"""
+		if self.points is None:
+			raise ValueError("all_nearest() needs an array backed tree, see from_points()")
+		n = len(self.points)
+		self.nnearest += n
+		best = np.full(n, -1, dtype=np.int64)
+		bestdistsq = np.full(n, np.inf)
+		if n < 2:
+			return best, bestdistsq
+
+		if getattr(self, '_leaves', None) is None:
+			self._leaves = self._leaftable()
+		for b in range(0, n, blocksize):
+			e = min(n, b + blocksize)
+			best[b:e], bestdistsq[b:e] = self._nearest_block(self.points[b:e], np.arange(b, e))
+		indices = np.empty(n, dtype=np.int64)
+		distsq = np.empty(n)
+		indices[self.index] = self.index[best]
+		distsq[self.index] = bestdistsq
+		return indices, distsq
+
+	def pairs_within(self, radius):
+		"""
+		Return an (m, 2) array with the original indices i < j of every
+		pair of points at most radius apart, sorted by i and then j.
+
+		This is a dual-tree traversal: (node, node) pairs are carried down
+		the tree a level at a time, of each unordered pair only one is kept
+		and only if their boxes are within radius. Needs an array backed
+		tree.
+		"""
+		if self.points is None:
+			raise ValueError("pairs_within() needs an array backed tree, see from_points()")
+		radiussq = radius * radius
+		result = [np.zeros((0, 2), dtype=np.int64)]
+		if len(self.points) > 1:
+			q = np.zeros(1, dtype=np.int64)
+			r = np.zeros(1, dtype=np.int64)
+			for level in range(self.level + 1):
+				self.count += len(q)
+				keep = box_box_distance_squared(self.bbmin[q], self.bbmax[q], self.bbmin[r], self.bbmax[r]) <= radiussq
+				q, r = q[keep], r[keep]
+				if level < self.level:
+					# a node paired with itself yields (left, left), (left, right) and (right, right)
+					ql, qr, rl, rr = self.left[q], self.right[q], self.left[r], self.right[r]
+					other = q != r
+					q = np.concatenate((ql, ql, qr, qr[other]))
+					r = np.concatenate((rl, rr, rr, rl[other]))
+			for b in range(0, len(q), 4096):
+				qs = self._slots(q[b:b + 4096])
+				rs = self._slots(r[b:b + 4096])
+				d = self.points[qs][:, :, None, :] - self.points[rs][:, None, :, :]
+				d = np.einsum('ijkl,ijkl->ijk', d, d)
+				# within a leaf paired with itself only count each pair once
+				inside = (d <= radiussq) & (qs[:, :, None] >= 0) & (rs[:, None, :] >= 0)
+				inside &= (q[b:b + 4096] != r[b:b + 4096])[:, None, None] | (qs[:, :, None] < rs[:, None, :])
+				m, i, j = np.nonzero(inside)
+				result.append(np.stack((self.index[qs[m, i]], self.index[rs[m, j]]), axis=1))
+		pairs = np.concatenate(result)
+		pairs.sort(axis=1)
+		return pairs[np.lexsort((pairs[:, 1], pairs[:, 0]))]
+
+	def _find_n(self, node, pos, k, heap, checkempty):
+
+		self.count+=1
+
+		if not (node.deleted or (checkempty and node.data is None)):
+			distsq = node.distance_squared(pos)
+			if len(heap) < k:
+				heappush(heap, (-distsq, self.count, node))
+			elif distsq < -heap[0][0]:
+				heapreplace(heap, (-distsq, self.count, node))
+
+		if pos[node.dir] - node.pos[node.dir] <= 0:
+			neartree, fartree = node.left, node.right
+		else:
+			neartree, fartree = node.right, node.left
+
+		if neartree is not None:
+			if len(heap) < k or self.count < self._maxcount:
+				self._find_n(neartree, pos, k, heap, checkempty)
+			else:
+				self._skip(neartree.rect.distance_squared(pos))
+		if fartree is not None:
+			if len(heap) < k:
+				self._find_n(fartree, pos, k, heap, checkempty)
+			else:
+				rectdistsq = fartree.rect.distance_squared(pos)
+				if rectdistsq < -heap[0][0] * self._shrink and self.count < self._maxcount:
+					self._find_n(fartree, pos, k, heap, checkempty)
+				elif rectdistsq < -heap[0][0]:
+					self._skip(rectdistsq)
+
+	def _find_n_array(self, node, pos, k, heap):
+
+		self.count+=1
+
+		axis = self.split_axis[node]
+		if axis < 0:
+			s, e = self.start[node], self.end[node]
+			d = self.points[s:e] - pos
+			d = np.einsum('ij,ij->i', d, d)
+			for i in np.argsort(d):
+				if len(heap) < k:
+					heappush(heap, (-d[i], s + i))
+				elif d[i] < -heap[0][0]:
+					heapreplace(heap, (-d[i], s + i))
+				else:
+					break
+			return
+
+		if pos[axis] < self.split_value[node]:
+			neartree, fartree = self.left[node], self.right[node]
+		else:
+			neartree, fartree = self.right[node], self.left[node]
+
+		if len(heap) < k or self.count < self._maxcount:
+			self._find_n_array(neartree, pos, k, heap)
+		else:
+			self._skip(box_distance_squared(self.bbmin[neartree], self.bbmax[neartree], pos))
+		if len(heap) < k:
+			self._find_n_array(fartree, pos, k, heap)
+		else:
+			rectdistsq = box_distance_squared(self.bbmin[fartree], self.bbmax[fartree], pos)
+			if rectdistsq < -heap[0][0] * self._shrink and self.count < self._maxcount:
+				self._find_n_array(fartree, pos, k, heap)
+			elif rectdistsq < -heap[0][0]:
+				self._skip(rectdistsq)
+
+	def find_n(self, pos, k, checkempty=False, epsilon=0.0, max_visits=None):
+		"""
+		Return a list of (node, distsq) tuples of the k nodes nearest to pos,
+		nearest first. A bounded max-heap holds the k best candidates found
+		so far and a subtree is only visited if its bounding box is closer
+		than the worst of those. epsilon and max_visits work as in nearest(),
+		the error bound applies to the k-th distance.
+		"""
+		self.nnearest+=1
+		self._approximate(epsilon, max_visits)
+		heap = []
+		if k < 1:
+			return []
+		if self.points is not None:
+			if len(self.points):
+				self._find_n_array(0, np.asarray(pos, dtype=np.float64), k, heap)
+			self._error(-heap[0][0] if len(heap) == k else None)
+			return [(self._arraynode(i), float(-d)) for d, i in sorted(heap, reverse=True)]
+		if self.root is not None:
+			self._find_n(self.root, pos, k, heap, checkempty)
+		self._error(-heap[0][0] if len(heap) == k else None)
+		return [(node, -d) for d, _, node in sorted(heap, key=lambda h: h[0], reverse=True)]
+
+	def _find_range(self, node, pos, radiussq, result, checkempty):
+
+		self.count+=1
+
+		if node.rect.distance_squared(pos) > radiussq:
+			return
+		if not (node.deleted or (checkempty and node.data is None)):
+			distsq = node.distance_squared(pos)
+			if distsq <= radiussq:
+				result.append((node, distsq))
+		if node.left is not None:
+			self._find_range(node.left, pos, radiussq, result, checkempty)
+		if node.right is not None:
+			self._find_range(node.right, pos, radiussq, result, checkempty)
+
+	def _find_range_array(self, node, pos, radiussq, result):
+
+		self.count+=1
+
+		if box_distance_squared(self.bbmin[node], self.bbmax[node], pos) > radiussq:
+			return
+		if self.split_axis[node] < 0:
+			s, e = self.start[node], self.end[node]
+			d = self.points[s:e] - pos
+			d = np.einsum('ij,ij->i', d, d)
+			inside = np.flatnonzero(d <= radiussq)
+			result.extend(zip(s + inside, d[inside]))
+			return
+		self._find_range_array(self.left[node], pos, radiussq, result)
+		self._find_range_array(self.right[node], pos, radiussq, result)
+
+	def find_range(self, pos, radius, checkempty=False):
+		"""
+		Return a list of (node, distsq) tuples of all nodes within radius
+		of pos, nearest first. Subtrees whose bounding box lies further
+		away than radius are skipped.
+		"""
+		self.nnearest+=1
+		result = []
+		radiussq = radius * radius
+		if self.points is not None:
+			if len(self.points):
+				self._find_range_array(0, np.asarray(pos, dtype=np.float64), radiussq, result)
+			return [(self._arraynode(i), float(d)) for i, d in sorted(result, key=lambda r: r[1])]
+		if self.root is not None:
+			self._find_range(self.root, pos, radiussq, result, checkempty)
+		return sorted(result, key=lambda r: r[1])
+
 	def __str__(self):
+		if self.points is not None:
+			return "<Tree %d points, %d nodes, depth %d>"%(len(self.points), len(self.split_axis), self.level)
 		return str(self.root)
 
+_worker_tree = None
+_worker_blocks = []
+
+def _worker_init(layout, dim, level, leafsize):
+	global _worker_tree
+	tree = Tree(dim)
+	tree.level = level
+	tree.leafsize = leafsize
+	tree.data = None
+	for attr, (name, shape, dtype) in layout.items():
+		shm = shared_memory.SharedMemory(name=name)
+		_worker_blocks.append(shm) # keep the mapping alive as long as the worker
+		setattr(tree, attr, np.ndarray(shape, dtype=dtype, buffer=shm.buf))
+	_worker_tree = tree
+
+def _worker_nearest(task):
+	qname, iname, dname, nq, start, end = task
+	blocks = [shared_memory.SharedMemory(name=name) for name in (qname, iname, dname)]
+	try:
+		queries = np.ndarray((nq, _worker_tree.dim), dtype=np.float64, buffer=blocks[0].buf)
+		indices = np.ndarray((nq,), dtype=np.int64, buffer=blocks[1].buf)
+		distsq = np.ndarray((nq,), dtype=np.float64, buffer=blocks[2].buf)
+		_worker_tree.resetcounters()
+		indices[start:end], distsq[start:end] = _worker_tree.nearest_many(queries[start:end])
+		del queries, indices, distsq
+		return _worker_tree.nnearest, _worker_tree.count
+	finally:
+		for shm in blocks:
+			shm.close()
+
+class QueryExecutor:
+	"""
+	Answer large query batches on an array backed tree with a pool of
+	worker processes.
+
+	The node arrays are copied to shared memory once, when the executor
+	is created, and every worker maps them when it starts, so the tree is
+	never pickled. Each call to nearest_many() puts the queries and the
+	output arrays in shared memory as well and hands out (start, end)
+	chunks. Use it as a context manager or call close() when done.
+	"""
+
+	def __init__(self, tree, processes=None):
+		if tree.points is None:
+			raise ValueError("QueryExecutor needs an array backed tree, see from_points()")
+		if tree._leaves is None:
+			tree._leaves = tree._leaftable() if len(tree.points) else np.zeros((0, 1), dtype=np.int64)
+		self.tree = tree
+		self.blocks = []
+		layout = {}
+		for attr in Tree.arrays:
+			a = np.ascontiguousarray(getattr(tree, attr))
+			shm = shared_memory.SharedMemory(create=True, size=max(1, a.nbytes))
+			self.blocks.append(shm)
+			np.ndarray(a.shape, dtype=a.dtype, buffer=shm.buf)[...] = a
+			layout[attr] = (shm.name, a.shape, a.dtype.str)
+		self.pool = Pool(processes, initializer=_worker_init, initargs=(layout, tree.dim, tree.level, tree.leafsize))
+
+	def nearest_many(self, queries, chunksize=16384):
+		'''like Tree.nearest_many() but the chunks of queries are answered in parallel'''
+		queries = np.asarray(queries, dtype=np.float64).reshape(-1, self.tree.dim)
+		nq = len(queries)
+		if nq == 0 or len(self.tree.points) == 0:
+			return self.tree.nearest_many(queries)
+		blocks = [shared_memory.SharedMemory(create=True, size=nq * 8 * k) for k in (self.tree.dim, 1, 1)]
+		try:
+			np.ndarray(queries.shape, dtype=np.float64, buffer=blocks[0].buf)[...] = queries
+			tasks = [(blocks[0].name, blocks[1].name, blocks[2].name, nq, start, min(nq, start + chunksize)) for start in range(0, nq, chunksize)]
+			for nnearest, count in self.pool.imap_unordered(_worker_nearest, tasks):
+				self.tree.nnearest += nnearest
+				self.tree.count += count
+			indices = np.ndarray((nq,), dtype=np.int64, buffer=blocks[1].buf).copy()
+			distsq = np.ndarray((nq,), dtype=np.float64, buffer=blocks[2].buf).copy()
+			return indices, distsq
+		finally:
+			for shm in blocks:
+				shm.close()
+				shm.unlink()
+
+	def close(self):
+		if self.pool is not None:
+			self.pool.close()
+			self.pool.join()
+			self.pool = None
+		for shm in self.blocks:
+			shm.close()
+			shm.unlink()
+		self.blocks = []
+
+	def __enter__(self):
+		return self
+
+	def __exit__(self, *exc):
+		self.close()
+
 if __name__ == "__main__":
 
 	class vector(list):
@@ -1,4 +1,7 @@
-from kdtree_native import Hyperrectangle,Tree
+from kdtree_native import Hyperrectangle,Tree,QueryExecutor
+import numpy as np
+import os
+import tempfile
 
 class vector(list):
 
@@ -24,6 +27,7 @@ class vector(list):
 
 from random import random,seed, shuffle
 from time import time
+from math import log, sqrt
 import unittest
 
 class TestVector(unittest.TestCase):
@@ -269,4 +273,336 @@ class TestTree(unittest.TestCase):
 		e3=time()-s
 		print("{0:7d}|{2:9d}|{1.level:11d}|{5:7d}|{3:10.2f}|{4:10.1f}".format(qsize,tree,tsize*10,float(tree.count)/qsize,e3,tsize*10//emptyq))
 		
+class TestQueries(unittest.TestCase):
+
+	def setUp(self):
+		seed(42)
+		self.points=[vector(random(),random(),random()) for p in range(500)]
+		self.queries=[vector(random(),random(),random()) for p in range(50)]
+		self.tree=Tree(3)
+		for p in self.points:
+			self.tree.insert(p,p)
+		self.arraytree=Tree.from_points(self.points, leafsize=4)
+
+	def brute(self, pos):
+		return sorted(((p-pos).dot(p-pos),i) for i,p in enumerate(self.points))
+
+	def test_find_n(self):
+		for q in self.queries:
+			expected=self.brute(q)
+			for k in (1,2,5,17):
+				result=self.tree.find_n(q,k)
+				self.assertEqual(len(result),k)
+				for (node, distsq), (d, i) in zip(result, expected):
+					self.assertAlmostEqual(distsq,d)
+				self.assertListEqual([node.data for node, _ in result],[self.points[i] for _, i in expected[:k]])
+				result=self.arraytree.find_n(q,k)
+				self.assertListEqual([node.data for node, _ in result],[i for _, i in expected[:k]])
+		self.assertEqual(len(self.tree.find_n(self.queries[0],1000)),500)
+		self.assertEqual(len(self.arraytree.find_n(self.queries[0],1000)),500)
+		self.assertListEqual(self.tree.find_n(self.queries[0],0),[])
+
+	def test_find_n_empty(self):
+		result=self.tree.find_n(self.points[3],2)
+		self.assertAlmostEqual(result[0][1],0.0)
+		result[0][0].data=None
+		result2=self.tree.find_n(self.points[3],1,checkempty=True)
+		self.assertIs(result2[0][0],result[1][0])
+
+	def test_find_range(self):
+		for q in self.queries:
+			expected=self.brute(q)
+			for radius in (0.0,0.05,0.1,0.3):
+				inside=[i for d, i in expected if d <= radius*radius]
+				result=self.tree.find_range(q,radius)
+				self.assertListEqual([node.data for node, _ in result],[self.points[i] for i in inside])
+				result=self.arraytree.find_range(q,radius)
+				self.assertListEqual([node.data for node, _ in result],inside)
+
+	def test_approximate(self):
+		for tree in (self.tree, self.arraytree):
+			for epsilon in (0.0, 0.5, 2.0):
+				tree.resetcounters()
+				for q in self.queries:
+					exact=self.brute(q)
+					node, distsq = tree.nearest(q, epsilon=epsilon)
+					self.assertLessEqual(sqrt(distsq),(1+epsilon)*sqrt(exact[0][0])+1e-12)
+					self.assertLessEqual(tree.lasterror,epsilon+1e-12)
+					result = tree.find_n(q, 5, epsilon=epsilon)
+					self.assertLessEqual(sqrt(result[-1][1]),(1+epsilon)*sqrt(exact[4][0])+1e-12)
+				self.assertLessEqual(tree.maxerror,epsilon+1e-12)
+				if epsilon == 0.0:
+					self.assertEqual(tree.maxerror,0.0)
+					exactcount=tree.count
+				else:
+					self.assertLess(tree.count,exactcount)
+
+	def test_max_visits(self):
+		for tree in (self.tree, self.arraytree):
+			for q in self.queries:
+				tree.resetcounters()
+				node, distsq = tree.nearest(q, max_visits=3)
+				self.assertIsNotNone(node)
+				self.assertLessEqual(tree.count,3+2*tree.level+2)
+				exact=self.brute(q)[0][0]
+				# the reported error bound must hold
+				self.assertLessEqual(sqrt(distsq),(1+tree.lasterror)*sqrt(exact)+1e-12)
+				result = tree.find_n(q, 4, max_visits=3)
+				self.assertEqual(len(result),4)
+
+	def test_counters(self):
+		self.tree.resetcounters()
+		for q in self.queries:
+			self.tree.find_n(q,3)
+		self.assertEqual(self.tree.nnearest,len(self.queries))
+		self.assertLess(self.tree.count,len(self.queries)*len(self.points)/4)
+		self.tree.resetcounters()
+		self.tree.find_range(self.queries[0],0.05)
+		self.assertLess(self.tree.count,len(self.points)/4)
+
+class TestDynamicTree(unittest.TestCase):
+
+	def setUp(self):
+		seed(42)
+
+	def depth(self, node):
+		if node is None:
+			return 0
+		return 1+max(self.depth(node.left),self.depth(node.right))
+
+	def check(self, tree, points):
+		self.assertEqual(len(tree),len(points))
+		self.assertLessEqual(self.depth(tree.root)-1,log(max(tree.size,1))/log(1/tree.alpha)+1)
+		for q in [vector(random(),random(),random()) for i in range(20)]:
+			node, distsq = tree.nearest(q)
+			expected=min((p-q).dot(p-q) for p in points.values())
+			self.assertAlmostEqual(distsq,expected)
+			self.assertFalse(node.deleted)
+
+	def test_sorted_inserts(self):
+		tree=Tree(3)
+		points={}
+		for i in range(1000):
+			p=vector(i/1000,i/1000,i/1000)
+			tree.insert(p,i)
+			points[i]=p
+		self.assertLess(self.depth(tree.root),25) # an unbalanced tree would be 1000 deep
+		self.check(tree,points)
+
+	def test_equal_points(self):
+		tree=Tree(3)
+		points={}
+		start=time()
+		for i in range(2000):
+			p=vector(0.5,0.5,0.5) if i%2 else vector(0.5,0.5,i/2000)
+			tree.insert(p,i)
+			points[i]=p
+		self.assertLess(time()-start,2.0) # every insert rebuilt a subtree before ties were broken
+		self.assertLess(self.depth(tree.root),35)
+		self.check(tree,points)
+		for i in range(1,2000,4):
+			self.assertEqual(tree.remove(i).data,i)
+			del points[i]
+		self.check(tree,points)
+
+	def test_remove(self):
+		tree=Tree(3)
+		points={}
+		for i in range(200):
+			p=vector(random(),random(),random())
+			tree.insert(p,i)
+			points[i]=p
+		node=tree.remove(7)
+		self.assertEqual(node.data,7)
+		self.assertIsNone(tree.remove(7))
+		del points[7]
+		node=tree.remove(8, points[8])
+		self.assertEqual(node.data,8)
+		del points[8]
+		self.check(tree,points)
+		for i in range(9,200):
+			tree.remove(i, points.pop(i))
+			if i % 37 == 0:
+				self.check(tree,points)
+		self.assertEqual(len(tree.find_range(vector(0,0,0),10)),7)
+		for i in range(7):
+			tree.remove(i)
+		self.assertEqual(len(tree),0)
+		self.assertIsNone(tree.root)
+		self.assertEqual(tree.nearest(vector(0,0,0)),(None,None))
+
+	def test_mixed(self):
+		tree=Tree(3)
+		points={}
+		n=0
+		for frame in range(20):
+			# move a third of the points every frame
+			for i in list(points)[::3]:
+				self.assertIsNotNone(tree.remove(i, points.pop(i)))
+			for i in range(100):
+				p=vector(random(),random(),random())
+				tree.insert(p,n)
+				points[n]=p
+				n+=1
+			self.check(tree,points)
+			self.assertLessEqual(tree.size-tree.live,(1-tree.alpha)*tree.size+1)
+
+	def test_static(self):
+		tree=Tree.from_points(np.zeros((3,3)))
+		self.assertRaises(ValueError,tree.insert,(0,0,0),0)
+		self.assertRaises(ValueError,tree.remove,0)
+
+class TestArrayTree(unittest.TestCase):
+
+	def setUp(self):
+		self.rng=np.random.default_rng(42)
+		self.points=self.rng.random((2000,3))
+		self.queries=self.rng.random((200,3))
+
+	def brute(self, pos, points):
+		d=points-pos
+		d=np.einsum('ij,ij->i',d,d)
+		i=np.argmin(d)
+		return i,d[i]
+
+	def test_structure(self):
+		tree=Tree.from_points(self.points, leafsize=8)
+		self.assertEqual(tree.level,8) # 2000/2**8 < 8 <= 2000/2**7
+		self.assertListEqual(sorted(tree.index.tolist()),list(range(2000)))
+		self.assertTrue(np.all(tree.points==self.points[tree.index]))
+		for node in range(len(tree.split_axis)):
+			p=tree.points[tree.start[node]:tree.end[node]]
+			self.assertTrue(np.all(p>=tree.bbmin[node]) and np.all(p<=tree.bbmax[node]))
+			if tree.split_axis[node]<0:
+				self.assertLessEqual(len(p),8)
+			if tree.split_axis[node]>=0:
+				axis=tree.split_axis[node]
+				l=tree.points[tree.start[tree.left[node]]:tree.end[tree.left[node]],axis]
+				r=tree.points[tree.start[tree.right[node]]:tree.end[tree.right[node]],axis]
+				self.assertTrue(np.all(l<=tree.split_value[node]))
+				self.assertTrue(np.all(r>=tree.split_value[node]))
+
+	def test_nearest(self):
+		for leafsize in (2,3,8,32):
+			tree=Tree.from_points(self.points, leafsize=leafsize)
+			for q in self.queries:
+				node, distsq = tree.nearest(q)
+				i, d = self.brute(q, self.points)
+				self.assertEqual(node.data,i)
+				self.assertTrue(np.all(node.pos==self.points[i]))
+				self.assertAlmostEqual(distsq,d)
+
+	def test_data(self):
+		data=["p%d"%i for i in range(len(self.points))]
+		tree=Tree.from_points(self.points, data)
+		node, distsq = tree.nearest(self.points[17])
+		self.assertEqual(node.data,"p17")
+		self.assertAlmostEqual(distsq,0.0)
+
+	def test_sorted_input(self):
+		# sorted input degenerates an insert() built tree but not a median split one
+		points=np.repeat(np.linspace(0,1,4096)[:,None],3,axis=1)
+		tree=Tree.from_points(points, leafsize=8)
+		self.assertEqual(tree.level,9)
+		node, distsq = tree.nearest((0.5,0.5,0.5))
+		i, d = self.brute(np.array((0.5,0.5,0.5)), points)
+		self.assertAlmostEqual(distsq,d)
+
+	def test_nearest_many(self):
+		for leafsize in (2,5,8,32):
+			tree=Tree.from_points(self.points, leafsize=leafsize)
+			indices, distsq = tree.nearest_many(self.queries, blocksize=64)
+			self.assertEqual(tree.nnearest,len(self.queries))
+			for q, i, d in zip(self.queries, indices, distsq):
+				j, e = self.brute(q, self.points)
+				self.assertEqual(i,j)
+				self.assertAlmostEqual(d,e)
+		indices, distsq = tree.nearest_many(self.points[::7])
+		self.assertListEqual(indices.tolist(),list(range(0,2000,7)))
+		self.assertTrue(np.all(distsq==0.0))
+		indices, distsq = tree.nearest_many(np.zeros((0,3)))
+		self.assertEqual(len(indices),0)
+		self.assertRaises(ValueError,Tree(3).nearest_many,self.queries)
+
+	def test_executor(self):
+		tree=Tree.from_points(self.points)
+		expected_indices, expected_distsq = tree.nearest_many(self.queries)
+		tree.resetcounters()
+		with QueryExecutor(tree, processes=2) as executor:
+			indices, distsq = executor.nearest_many(self.queries, chunksize=30)
+			self.assertListEqual(indices.tolist(),expected_indices.tolist())
+			self.assertTrue(np.allclose(distsq,expected_distsq))
+			self.assertEqual(tree.nnearest,len(self.queries))
+			self.assertGreater(tree.count,0)
+			indices, distsq = executor.nearest_many(np.zeros((0,3)))
+			self.assertEqual(len(indices),0)
+		self.assertRaises(ValueError,QueryExecutor,Tree(3))
+
+	def test_save_open(self):
+		tree=Tree.from_points(self.points, np.arange(len(self.points))*10)
+		expected_indices, expected_distsq = tree.nearest_many(self.queries)
+		with tempfile.TemporaryDirectory() as tmp:
+			path=os.path.join(tmp,"tree.kd")
+			tree.save(path)
+			for mmap in (True, False):
+				copy=Tree.open(path, mmap=mmap)
+				self.assertEqual(copy.level,tree.level)
+				self.assertEqual(isinstance(copy.points,np.memmap),mmap)
+				for attr in Tree.arrays:
+					self.assertTrue(np.array_equal(getattr(copy,attr),getattr(tree,attr)))
+				indices, distsq = copy.nearest_many(self.queries)
+				self.assertListEqual(indices.tolist(),expected_indices.tolist())
+				node, distsq = copy.nearest(self.points[5])
+				self.assertEqual(node.data,50)
+				del copy
+			with open(path,'r+b') as f:
+				f.seek(len(Tree.magic))
+				f.write(b'\x63')
+			self.assertRaises(ValueError,Tree.open,path)
+			Tree.from_points(np.zeros((0,3))).save(path)
+			self.assertEqual(Tree.open(path).nearest((0,0,0)),(None,None))
+		self.assertRaises(ValueError,Tree(3).save,"unused")
+		self.assertRaises(ValueError,Tree.from_points(self.points,["a"]*len(self.points)).save,"unused")
+
+	def test_all_nearest(self):
+		points=np.vstack((self.points,self.points[:10])) # a few duplicates
+		d=points[:,None,:]-points[None,:,:]
+		d=np.einsum('ijk,ijk->ij',d,d)
+		np.fill_diagonal(d,np.inf)
+		for leafsize in (2,3,8):
+			tree=Tree.from_points(points, leafsize=leafsize)
+			indices, distsq = tree.all_nearest()
+			self.assertTrue(np.allclose(distsq,d.min(axis=1)))
+			self.assertTrue(np.allclose(d[np.arange(len(points)),indices],distsq))
+			self.assertFalse(np.any(indices==np.arange(len(points))))
+		self.assertListEqual(Tree.from_points(self.points[:1]).all_nearest()[0].tolist(),[-1])
+		indices, distsq = Tree.from_points(self.points[:2]).all_nearest()
+		self.assertListEqual(indices.tolist(),[1,0])
+
+	def test_pairs_within(self):
+		d=self.points[:,None,:]-self.points[None,:,:]
+		d=np.einsum('ijk,ijk->ij',d,d)
+		for radius in (0.0,0.02,0.05):
+			i, j = np.nonzero(np.triu(d<=radius*radius,1))
+			for leafsize in (2,8):
+				tree=Tree.from_points(self.points, leafsize=leafsize)
+				pairs=tree.pairs_within(radius)
+				self.assertListEqual(pairs.tolist(),np.stack((i,j),axis=1).tolist())
+		self.assertEqual(Tree.from_points(self.points[:1]).pairs_within(1.0).shape,(0,2))
+
+	def test_small(self):
+		tree=Tree.from_points(np.zeros((0,3)))
+		self.assertEqual(tree.nearest((0,0,0)),(None,None))
+		for n in range(1,20):
+			points=self.points[:n]
+			tree=Tree.from_points(points, leafsize=2)
+			for q in self.queries[:10]:
+				node, distsq = tree.nearest(q)
+				i, d = self.brute(q, points)
+				self.assertEqual(node.data,i)
+			indices, distsq = tree.nearest_many(self.queries[:10])
+			for q, j in zip(self.queries[:10], indices):
+				i, d = self.brute(q, points)
+				self.assertEqual(i,j)
+
 unittest.main()
@@ -35,7 +35,13 @@ from mathutils import Vector
 from math import acos, atan2, pi
 from random import random, seed
 
-def cosine_transform(scene):
+def environment_samples(scene):
+    """
+    Return (p, d) with the pixels of the world texture scaled down to
+    256 x 128, as an (y, x, channels) array, and the (y, x, 3) array of
+    unit direction vectors they correspond to, or None if there is no
+    world texture.
+    """
     tex = scene.world.active_texture
     if tex:
         # scale image to a managable size
@@ -50,9 +56,6 @@ def cosine_transform(scene):
         theta = (np.arange(y, dtype=np.float32)/(y-1) - 0.5)*np.pi
         phi = (np.arange(x, dtype=np.float32)/(x-1) - 0.5)*2*np.pi
         
-        # allocate space for the convoluted colors
-        c = np.zeros(p.shape, dtype=np.float32)
-        
         # calculate the cartesian direction vectors (r = 1)
         d = np.empty((y,x,3), dtype=np.float32)
         costheta = np.cos(theta)
@@ -62,6 +65,14 @@ def cosine_transform(scene):
         d[:,:,0] = np.outer(costheta, cosphi)
         d[:,:,1] = np.outer(costheta, sinphi)
         d[:,:,2] = np.outer(sintheta, np.ones(x, dtype=np.float32))
+        return p, d
+    return None
+
+def cosine_transform(scene):
+    samples = environment_samples(scene)
+    if samples:
+        p, d = samples
+        y,x = p.shape[:2]
 
         # convert d to a single list of 3-vectors
         d.shape = -1,3
@@ -80,7 +91,49 @@ def cosine_transform(scene):
         wc.shape = y,x,-1
         return wc
     return None
-        
+
+def sh_basis(d):
+    """return the (n,9) real spherical harmonics up to order 2 for the (n,3) unit vectors d"""
+    x, y, z = d[:,0], d[:,1], d[:,2]
+    return np.stack((
+        np.full_like(x, 0.282095),
+        0.488603*y, 0.488603*z, 0.488603*x,
+        1.092548*x*y, 1.092548*y*z, 0.315392*(3*z*z - 1), 1.092548*x*z, 0.546274*(x*x - y*y),
+        ), axis=1)
+
+# the clamped cosine max(0, n.d) in spherical harmonics has only these
+# bands, the order 3 band is zero and higher bands are negligible
+sh_cosine = np.array([np.pi] + [2*np.pi/3]*3 + [np.pi/4]*5, dtype=np.float32)
+
+def sh_irradiance(scene):
+    """
+    Return the same array as cosine_transform() but calculated with
+    spherical harmonics (see Ramamoorthi & Hanrahan, An Efficient 
+    Representation for Irradiance Environment Maps). The environment is
+    projected on the 9 basis functions in one pass, the convolution with 
+    the clamped cosine then is a scale of every coefficient and the 
+    result is evaluated for every direction again, so nothing of size
+    pixels x pixels is ever needed.
+
+    Nine coefficients only hold the low frequencies of the environment: a
+    smooth sky comes out within a few percent, but a small bright light
+    like a sun rings, and in directions that get little light the error
+    can be many times the true value. Negative results from that
+    ringing are clamped to zero. Use cosine_transform() if that matters.
+    """
+    samples = environment_samples(scene)
+    if samples:
+        p, d = samples
+        y,x = p.shape[:2]
+        # just like cosine_transform() every pixel counts the same
+        basis = sh_basis(d.reshape(-1,3))
+        coefficients = basis.T @ p.reshape(x*y,-1)
+        wc = basis @ (sh_cosine[:,None] * coefficients) * (scene.world.light_settings.environment_energy / (x*y))
+        np.maximum(wc, 0, out=wc)
+        wc.shape = y,x,-1
+        return wc
+    return None
+
 X = Vector((1,0,0))
 Y = Vector((0,1,0))
 Z = Vector((0,0,1))
@@ -221,7 +274,7 @@ class CustomRenderEngine(bpy.types.RenderEngine):
     def render_scene(self, scene):
         gi = None
         if scene.world.light_settings.use_environment_light:
-            gi = cosine_transform(scene)
+            gi = sh_irradiance(scene)
         # create a buffer to store the calculated intensities
         height, width = self.size_y, self.size_x
         buf = np.ones(width*height*4)
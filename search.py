@@ -1,4 +1,5 @@
 import numpy as np
+from math import prod
 
 def divide(points, N):
     min = np.min(points)
@@ -6,50 +7,340 @@ def divide(points, N):
     w = max - min
     ind = np.empty_like(points,dtype=np.int32)
     ind[:] = ((points - min)/w)*N
+    np.clip(ind, 0, N-1, out=ind)  # points at max would end up in cell N
     return ind, min, max, w
 
-def search(point, points, ind, low, w, N):
-    pi = np.empty_like(point,dtype=np.int32)
-    pi[:] = ((point - low)/w)*N
-    
-    found = False
-    r = 1
-    while not found:
-        pix = np.array([min(max(0,p),N-1) for p in range(pi[0]-r,pi[0]+r+1)], dtype=np.int32)
-        piy = np.array([min(max(0,p),N-1) for p in range(pi[1]-r,pi[1]+r+1)], dtype=np.int32)
-        piz = np.array([min(max(0,p),N-1) for p in range(pi[2]-r,pi[2]+r+1)], dtype=np.int32)
-        
-        pidx = np.in1d(ind[:,0], pix)
-        pidy = np.in1d(ind[:,1], piy)
-        pidz = np.in1d(ind[:,2], piz)
-        pids = np.logical_and(pidx,np.logical_and(pidy,pidz))
-        
-        diff = points[pids] - point
+def grid(points, N):
+    """
+    Return a grid index (order, occupied, offsets, low, w) for the points.
+
+    order lists the point indices sorted by cell id (x*N + y)*N + z and
+    occupied the sorted ids of the cells that hold any points. The points
+    in cell occupied[i] are order[offsets[i]:offsets[i+1]], so a query 
+    only has to look at the cells it needs, and the index stays the size
+    of the points even when N**3 is much larger.
+    """
+    ind, low, high, w = divide(points, N)
+    cell = (ind[:,0].astype(np.int64)*N + ind[:,1])*N + ind[:,2]
+    order = np.argsort(cell, kind='stable')
+    occupied, counts = np.unique(cell[order], return_counts=True)
+    offsets = np.concatenate(([0], np.cumsum(counts)))
+    return order, occupied, offsets, low, w
+
+def ring(r):
+    """return the (m,3) offsets of the cells at chebyshev distance r from a cell"""
+    d = np.arange(-r, r+1)
+    cube = np.stack(np.meshgrid(d, d, d, indexing='ij'), axis=-1).reshape(-1,3)
+    return cube[np.max(np.abs(cube), axis=1) == r]
+
+def _search(queries, points, order, occupied, offsets, low, w, N, chunk=1024, maxring=4, budget=1 << 22):
+    nq = len(queries)
+    cellsize = w / N
+    c = np.clip(((queries - low)/w*N).astype(np.int64), 0, N-1)
+    ids = np.full(nq, -1, dtype=np.int64)
+    dist = np.full(nq, np.inf)
+    rings = np.zeros(nq, dtype=np.int64)
+    # the queries are handled in chunks, so the (query, cell) pairs of a ring stay small
+    for b in range(0, nq, chunk):
+        active = np.arange(b, min(b + chunk, nq))
+        r = 0
+        while len(active) and r <= maxring:
+            cells = c[active][:,None,:] + ring(r)[None,:,:]
+            inside = np.all((cells >= 0) & (cells < N), axis=2)
+            q = np.broadcast_to(active[:,None], inside.shape)[inside]
+            cells = cells[inside]
+            cell = (cells[:,0]*N + cells[:,1])*N + cells[:,2]
+            i = np.minimum(np.searchsorted(occupied, cell), len(occupied) - 1)
+            start = offsets[i]
+            # empty cells are not in occupied and hold no points
+            length = np.where(occupied[i] == cell, offsets[i+1] - start, 0)
+            # one (query, point) pair for every point in every cell of the ring,
+            # in blocks of cells holding about budget points together
+            end = np.cumsum(length)
+            first = 0
+            while first < len(length):
+                last = max(first + 1, int(np.searchsorted(end, end[first] - length[first] + budget, side='right')))
+                qb = np.repeat(q[first:last], length[first:last])
+                if len(qb):
+                    offset = end[first] - length[first]
+                    pids = order[np.repeat(start[first:last] - (end[first:last] - length[first:last] - offset), length[first:last]) + np.arange(len(qb))]
+                    diff = points[pids] - queries[qb]
+                    d = np.einsum('ij,ij->i', diff, diff)
+                    o = np.lexsort((d, qb))
+                    o = o[np.r_[True, qb[o][1:] != qb[o][:-1]]]
+                    o = o[d[o] < dist[qb[o]]]
+                    ids[qb[o]] = pids[o]
+                    dist[qb[o]] = d[o]
+                first = last
+            rings[active] = r
+            # anything outside the cube of cells searched so far is at least margin away
+            ca = c[active]
+            p = queries[active]
+            lo = np.where(ca - r <= 0, np.inf, p - (low + (ca - r)*cellsize))
+            hi = np.where(ca + r >= N-1, np.inf, low + (ca + r + 1)*cellsize - p)
+            margin = np.minimum(np.min(lo, axis=1), np.min(hi, axis=1))
+            active = active[dist[active] > margin*margin]
+            r += 1
+        # queries far from any point (in an empty region) are cheaper to finish by brute force
+        if len(active):
+            sqnorm = np.einsum('ij,ij->i', points, points)
+            step = max(1, budget // max(1, len(points)))
+            for k in range(0, len(active), step):
+                qa = active[k:k + step]
+                d = sqnorm[None,:] - 2 * queries[qa] @ points.T
+                nearest = np.argmin(d, axis=1)
+                diff = points[nearest] - queries[qa]
+                ids[qa] = nearest
+                dist[qa] = np.einsum('ij,ij->i', diff, diff)
+    return ids, dist, rings
+
+def search(point, points, order, occupied, offsets, low, w, N):
+    ids, dist, rings = _search(np.asarray(point, dtype=np.float64).reshape(1,3), points, order, occupied, offsets, low, w, N)
+    return points[ids[0]],ids[0],dist[0],rings[0]
+
+def search_many(queries, points, order, occupied, offsets, low, w, N):
+    """
+    Return (ids, dist) arrays with for every query point the index of the
+    nearest point and its squared distance. All queries expand their ring
+    of cells together, each query drops out as soon as no cell outside its
+    searched cube can hold anything closer. Queries are processed in chunks
+    and those still searching after a few rings, typically in an empty
+    region, are finished by brute force.
+    """
+    ids, dist, rings = _search(np.asarray(queries, dtype=np.float64).reshape(-1,3), points, order, occupied, offsets, low, w, N)
+    return ids, dist
+
+def interleave(ind):
+    """return the 3D Morton keys (uint64) of an (n,3) array of integer cell coordinates < 2**21"""
+    keys = np.zeros(len(ind), dtype=np.uint64)
+    for axis in range(3):
+        x = ind[:,axis].astype(np.uint64) & np.uint64(0x1fffff)
+        x = (x | x << np.uint64(32)) & np.uint64(0x1f00000000ffff)
+        x = (x | x << np.uint64(16)) & np.uint64(0x1f0000ff0000ff)
+        x = (x | x << np.uint64(8)) & np.uint64(0x100f00f00f00f00f)
+        x = (x | x << np.uint64(4)) & np.uint64(0x10c30c30c30c30c3)
+        x = (x | x << np.uint64(2)) & np.uint64(0x1249249249249249)
+        keys |= x << np.uint64(axis)
+    return keys
+
+def deinterleave(keys):
+    """return the (n,3) integer cell coordinates of an array of Morton keys"""
+    keys = np.asarray(keys, dtype=np.uint64)
+    ind = np.empty((len(keys), 3), dtype=np.int64)
+    for axis in range(3):
+        x = (keys >> np.uint64(axis)) & np.uint64(0x1249249249249249)
+        x = (x | x >> np.uint64(2)) & np.uint64(0x10c30c30c30c30c3)
+        x = (x | x >> np.uint64(4)) & np.uint64(0x100f00f00f00f00f)
+        x = (x | x >> np.uint64(8)) & np.uint64(0x1f0000ff0000ff)
+        x = (x | x >> np.uint64(16)) & np.uint64(0x1f00000000ffff)
+        x = (x | x >> np.uint64(32)) & np.uint64(0x1fffff)
+        ind[:,axis] = x
+    return ind
+
+def morton(points, bits=10):
+    """
+    Return a Z-order index (order, keys, low, scale, bits) for the points.
+
+    Unlike divide() every axis is normalized on its own, so each one gets
+    2**bits cells whatever the shape of the point cloud. order lists the
+    point indices sorted by Morton key and keys the sorted keys.
+    """
+    low = np.min(points, axis=0)
+    extent = np.max(points, axis=0) - low
+    scale = np.where(extent > 0, (1 << bits) / np.where(extent > 0, extent, 1), 0.0)
+    keys = interleave(cells(points, low, scale, bits))
+    order = np.argsort(keys, kind='stable')
+    return order, keys[order], low, scale, bits
+
+def cells(points, low, scale, bits):
+    return np.clip(((np.asarray(points) - low)*scale).astype(np.int64), 0, (1 << bits) - 1)
+
+def _spread(x):
+    x &= 0x1fffff
+    x = (x | x << 32) & 0x1f00000000ffff
+    x = (x | x << 16) & 0x1f0000ff0000ff
+    x = (x | x << 8) & 0x100f00f00f00f00f
+    x = (x | x << 4) & 0x10c30c30c30c30c3
+    return (x | x << 2) & 0x1249249249249249
+
+def _compact(x):
+    x &= 0x1249249249249249
+    x = (x | x >> 2) & 0x10c30c30c30c30c3
+    x = (x | x >> 4) & 0x100f00f00f00f00f
+    x = (x | x >> 8) & 0x1f0000ff0000ff
+    x = (x | x >> 16) & 0x1f00000000ffff
+    return (x | x >> 32) & 0x1fffff
+
+def litmax_bigmin(zmin, zmax):
+    """
+    Split the box with Morton corner keys zmin, zmax at the most significant
+    bit where they differ and return (litmax, bigmin): the largest key of the
+    lower half and the smallest key of the upper half. Every key between the
+    two lies outside the box.
+    """
+    pos = (zmin ^ zmax).bit_length() - 1
+    axis, level = pos % 3, pos // 3
+    mask = 0x1249249249249249 << axis # the bits of this axis
+    split = (_compact(zmax >> axis) >> level) << level
+    litmax = (zmax & ~mask) | (_spread(split - 1) << axis)
+    bigmin = (zmin & ~mask) | (_spread(split) << axis)
+    return litmax, bigmin
+
+def decompose(zmin, zmax, maxranges=64):
+    """
+    Return a sorted list of (first, last) Morton key ranges that together
+    cover the box with corner keys zmin, zmax, found by repeatedly splitting
+    with litmax_bigmin(). A range is not split further once all keys in it
+    lie inside the box or once there are maxranges ranges, in which case
+    some keys outside the box are included.
+    """
+    ranges = []
+    stack = [(int(zmin), int(zmax))]
+    while stack:
+        a, b = stack.pop()
+        volume = prod(_compact(b >> axis) - _compact(a >> axis) + 1 for axis in range(3))
+        if b - a + 1 == volume or len(ranges) + len(stack) + 1 >= maxranges:
+            ranges.append((a, b))
+            continue
+        litmax, bigmin = litmax_bigmin(a, b)
+        stack.append((bigmin, b))
+        stack.append((a, litmax))
+    return ranges
+
+def highest_bit(x):
+    """return the position of the highest set bit of every element of the uint64 array x (0 for 0)"""
+    x = np.asarray(x, dtype=np.uint64).copy()
+    pos = np.zeros(len(x), dtype=np.int64)
+    for shift in (32, 16, 8, 4, 2, 1):
+        high = x >> np.uint64(shift) != 0
+        pos += high * shift
+        x[high] >>= np.uint64(shift)
+    return pos
+
+def decompose_many(zmin, zmax, maxranges=64):
+    """
+    Vectorized decompose() for many boxes at once. Return (box, first, last)
+    arrays, the Morton key ranges first..last together cover box number
+    box. All ranges are split one level at a time, a box stops splitting
+    once it has maxranges ranges.
+    """
+    box = np.arange(len(zmin))
+    a = np.asarray(zmin, dtype=np.uint64)
+    b = np.asarray(zmax, dtype=np.uint64)
+    done = []
+    count = np.ones(len(box), dtype=np.int64)
+    one = np.uint64(1)
+    while len(box):
+        ca, cb = deinterleave(a), deinterleave(b)
+        volume = np.prod((cb - ca + 1).astype(np.uint64), axis=1)
+        split = b - a + one != volume
+        # allow only as many splits per box as keep it below maxranges ranges,
+        # box is sorted so the rank of a range within its box is easy to find
+        candidates = np.flatnonzero(split)
+        group = box[candidates]
+        rank = np.arange(len(candidates)) - np.searchsorted(group, group)
+        split[candidates[rank >= maxranges - count[group]]] = False
+        done.append((box[~split], a[~split], b[~split]))
+        box, a, b, ca, cb = box[split], a[split], b[split], ca[split], cb[split]
+        np.add.at(count, box, 1)
+        # litmax_bigmin() for all ranges at once: cut at the highest differing bit
+        pos = highest_bit(a ^ b)
+        axis, level = pos % 3, pos // 3
+        rows = np.arange(len(box))
+        cut = (cb[rows, axis] >> level) << level
+        cb[rows, axis] = cut - 1
+        ca[rows, axis] = cut
+        litmax, bigmin = interleave(cb), interleave(ca)
+        box = np.repeat(box, 2)
+        a = np.stack((a, bigmin), axis=1).ravel()
+        b = np.stack((litmax, b), axis=1).ravel()
+    box, first, last = (np.concatenate(x) for x in zip(*done))
+    return box, first, last
+
+def morton_box(lo, hi, points, order, keys, low, scale, bits, maxranges=64):
+    """return the indices of all points inside the axis aligned box lo, hi"""
+    zmin, zmax = interleave(cells(np.array([lo, hi]), low, scale, bits))
+    ranges = np.array(decompose(zmin, zmax, maxranges), dtype=np.uint64).reshape(-1,2)
+    start = np.searchsorted(keys, ranges[:,0], side='left')
+    end = np.searchsorted(keys, ranges[:,1], side='right')
+    length = end - start
+    first = np.cumsum(length) - length
+    ids = order[np.repeat(start - first, length) + np.arange(np.sum(length))]
+    # cells on the border of the box hold points outside it too
+    p = points[ids]
+    return ids[np.all((p >= lo) & (p <= hi), axis=1)]
+
+def morton_knn(point, k, points, order, keys, low, scale, bits):
+    """
+    Return (ids, dist) of the k points nearest to point, nearest first, with
+    squared distances. See morton_knn_many().
+    """
+    ids, dist = morton_knn_many(np.asarray(point, dtype=np.float64).reshape(1,3), k, points, order, keys, low, scale, bits)
+    return ids[0], dist[0]
+
+def morton_knn_many(queries, k, points, order, keys, low, scale, bits, maxranges=16, chunk=4096):
+    """
+    Return (ids, dist) arrays of shape (m,k) with for each of the m queries
+    the k nearest points, nearest first, with squared distances. The k
+    points on either side of a query's position in Z-order give an upper
+    bound on the k-th distance, a box query of that size then yields every
+    point that could be closer. All queries in a chunk go through every
+    step together.
+    """
+    queries = np.asarray(queries, dtype=np.float64).reshape(-1,3)
+    n = len(order)
+    k = min(k, n)
+    allids = np.empty((len(queries), k), dtype=np.int64)
+    alldist = np.empty((len(queries), k))
+    window = min(2*k, n)
+    for c in range(0, len(queries), chunk):
+        q = queries[c:c+chunk]
+        m = len(q)
+        i = np.searchsorted(keys, interleave(cells(q, low, scale, bits)))
+        seed = order[np.clip(i - k, 0, n - window)[:,None] + np.arange(window)]
+        diff = points[seed] - q[:,None,:]
+        rsq = np.partition(np.einsum('ijk,ijk->ij', diff, diff), k-1, axis=1)[:,k-1]
+        r = np.sqrt(rsq)
+
+        zmin = interleave(cells(q - r[:,None], low, scale, bits))
+        zmax = interleave(cells(q + r[:,None], low, scale, bits))
+        box, first, last = decompose_many(zmin, zmax, maxranges)
+        start = np.searchsorted(keys, first, side='left')
+        length = np.searchsorted(keys, last, side='right') - start
+        box = np.repeat(box, length)
+        offset = np.cumsum(length) - length
+        ids = order[np.repeat(start - offset, length) + np.arange(len(box))]
+        diff = points[ids] - q[box]
         dist = np.einsum('ij,ij->i', diff, diff)
-        if len(dist):
-            i = np.argmin(dist)
-            id = np.flatnonzero(pids)[i]
-            return points[id],id,dist[i],r
-        r += 1
+        # cells on the border of a box hold points outside it too, but
+        # every query has at least k points within r (the slack is for rounding)
+        inside = dist <= rsq[box] * (1 + 1e-9)
+        box, ids, dist = box[inside], ids[inside], dist[inside]
+        o = np.lexsort((dist, box))
+        box, ids, dist = box[o], ids[o], dist[o]
+        rank = np.arange(len(box)) - np.searchsorted(box, box)
+        keep = rank < k
+        allids[c + box[keep], rank[keep]] = ids[keep]
+        alldist[c + box[keep], rank[keep]] = dist[keep]
+    return allids, alldist
 
 if __name__ == "__main__":
 
     from time import time
-    
+
     PTS = 1000000
     points = np.random.random(3 * PTS)
     points.shape = -1,3
-    
+
     N=100
-    ind, lo, hi, w = divide(points,N)
-    
-    #for p,i in zip(points,ind):
-    #    print(p,i)
+    start = time()
+    order, occupied, offsets, lo, w = grid(points,N)
+    print(time()-start)
 
     p = np.array([0.5,0.5,0.5])
 
     start = time()
-    r = search(p, points, ind, lo, w, N)
+    r = search(p, points, order, occupied, offsets, lo, w, N)
     print(time()-start)
     print(p,r)
 
@@ -59,4 +350,14 @@ if __name__ == "__main__":
     i = np.argmin(dist)
     print(time()-start)
     print(p, (points[i], i, dist[i]))
-    
+
+    queries = np.random.random((10000,3))
+    start = time()
+    ids, dist = search_many(queries, points, order, occupied, offsets, lo, w, N)
+    print(time()-start)
+
+    index = morton(points)
+    start = time()
+    r = morton_knn(p, 1, points, *index)
+    print(time()-start)
+    print(p, r)
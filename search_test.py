@@ -0,0 +1,118 @@
+import numpy as np
+import unittest
+
+import search
+
+def brute_force(queries, points, k=1):
+    """squared distances to the k nearest points of every query, nearest first"""
+    d = np.sum((queries[:,None,:] - points[None,:,:])**2, axis=2)
+    return np.sort(d, axis=1)[:,:k]
+
+def clouds(rng, n=2000):
+    """a uniform cube, a flat and long anisotropic cloud and two tight clusters"""
+    yield 'uniform', rng.random((n,3))
+    yield 'anisotropic', rng.random((n,3)) * np.array([100.0, 1.0, 0.01])
+    yield 'clusters', np.concatenate((rng.normal(scale=0.01, size=(n//2,3)), rng.normal(loc=5.0, scale=0.01, size=(n - n//2,3))))
+
+def queries_for(rng, points, m=300):
+    """queries inside the bounding box and up to its size beyond it on every side"""
+    low, high = np.min(points, axis=0), np.max(points, axis=0)
+    return low + (rng.random((m,3)) * 3 - 1) * (high - low)
+
+class TestGrid(unittest.TestCase):
+
+    def test_search_many(self):
+        rng = np.random.default_rng(1)
+        for name, points in clouds(rng):
+            queries = queries_for(rng, points)
+            expected = brute_force(queries, points)[:,0]
+            for N in (1, 5, 13, 200):
+                with self.subTest(cloud=name, N=N):
+                    index = search.grid(points, N)
+                    ids, dist = search.search_many(queries, points, *index, N)
+                    np.testing.assert_allclose(dist, expected)
+                    np.testing.assert_allclose(np.sum((points[ids] - queries)**2, axis=1), dist)
+
+    def test_offsets_only_cover_occupied_cells(self):
+        points = np.random.default_rng(2).random((100,3))
+        order, occupied, offsets, low, w = search.grid(points, 1000)
+        self.assertLessEqual(len(occupied), len(points))
+        self.assertEqual(len(offsets), len(occupied) + 1)
+        self.assertEqual(offsets[-1], len(points))
+        self.assertEqual(sorted(order), list(range(len(points))))
+
+    def test_search(self):
+        rng = np.random.default_rng(3)
+        points = rng.random((500,3))
+        index = search.grid(points, 8)
+        for q in (np.array([0.5, 0.5, 0.5]), np.array([-3.0, 0.2, 7.0])):
+            p, i, dist, rings = search.search(q, points, *index, 8)
+            self.assertAlmostEqual(dist, brute_force(q[None,:], points)[0,0])
+            np.testing.assert_array_equal(p, points[i])
+
+class TestMorton(unittest.TestCase):
+
+    def test_interleave(self):
+        ind = np.random.default_rng(4).integers(0, 1 << 21, size=(1000,3))
+        np.testing.assert_array_equal(search.deinterleave(search.interleave(ind)), ind)
+
+    def test_decompose_many(self):
+        rng = np.random.default_rng(5)
+        bits = 3
+        allcells = np.stack(np.meshgrid(*[np.arange(1 << bits)]*3, indexing='ij'), axis=-1).reshape(-1,3)
+        allkeys = search.interleave(allcells)
+        a = rng.integers(0, 1 << bits, size=(50,3))
+        b = rng.integers(0, 1 << bits, size=(50,3))
+        lo, hi = np.minimum(a, b), np.maximum(a, b)
+        zmin, zmax = search.interleave(lo), search.interleave(hi)
+        for maxranges in (1, 4, 64):
+            box, first, last = search.decompose_many(zmin, zmax, maxranges)
+            for j in range(len(lo)):
+                with self.subTest(box=j, maxranges=maxranges):
+                    ranges = sorted(zip(first[box == j].tolist(), last[box == j].tolist()))
+                    self.assertLessEqual(len(ranges), maxranges)
+                    covered = np.zeros(len(allkeys), dtype=bool)
+                    for f, l in ranges:
+                        covered |= (allkeys >= f) & (allkeys <= l)
+                    inside = np.all((allcells >= lo[j]) & (allcells <= hi[j]), axis=1)
+                    self.assertTrue(np.all(covered[inside]))
+                    # decompose() splits depth first and decompose_many() level by
+                    # level, so they only agree when neither runs out of ranges
+                    if len(ranges) < maxranges:
+                        self.assertEqual(ranges, search.decompose(zmin[j], zmax[j], maxranges))
+                        np.testing.assert_array_equal(covered, inside)
+
+    def test_morton_box(self):
+        rng = np.random.default_rng(6)
+        for name, points in clouds(rng):
+            index = search.morton(points, bits=6)
+            low, high = np.min(points, axis=0), np.max(points, axis=0)
+            for j in range(20):
+                with self.subTest(cloud=name, box=j):
+                    corners = low + (rng.random((2,3)) * 1.4 - 0.2) * (high - low)
+                    lo, hi = np.min(corners, axis=0), np.max(corners, axis=0)
+                    expected = np.flatnonzero(np.all((points >= lo) & (points <= hi), axis=1))
+                    np.testing.assert_array_equal(np.sort(search.morton_box(lo, hi, points, *index)), expected)
+
+    def test_morton_knn_many(self):
+        rng = np.random.default_rng(7)
+        for name, points in clouds(rng):
+            queries = queries_for(rng, points)
+            # with 2 bits there are 64 cells, so k = 100 needs several of them
+            for bits, k in ((10, 1), (10, 8), (2, 100)):
+                with self.subTest(cloud=name, bits=bits, k=k):
+                    index = search.morton(points, bits=bits)
+                    ids, dist = search.morton_knn_many(queries, k, points, *index, chunk=128)
+                    np.testing.assert_allclose(dist, brute_force(queries, points, k))
+                    np.testing.assert_allclose(np.sum((points[ids] - queries[:,None,:])**2, axis=2), dist)
+                    self.assertTrue(all(len(set(row)) == k for row in ids.tolist()))
+
+    def test_morton_knn(self):
+        rng = np.random.default_rng(8)
+        points = rng.random((50,3))
+        ids, dist = search.morton_knn([2.0, 0.5, 0.5], 100, points, *search.morton(points))
+        self.assertEqual(sorted(ids.tolist()), list(range(50)))
+        np.testing.assert_allclose(dist, brute_force(np.array([[2.0, 0.5, 0.5]]), points, 50)[0])
+
+if __name__ == '__main__':
+    unittest.main()
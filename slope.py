@@ -35,9 +35,33 @@ bl_info = {
 from math import pi, pow
 from re import search
 import bpy
+import numpy as np
 from mathutils import Vector
 
 
+def set_weights(vertex_group, weights, indices=None, steps=0):
+    """
+    Assign weights[i] to vertex indices[i] (to vertex i if indices is None)
+    with a single vertex_group.add() call for every distinct weight. With
+    steps > 0 the weights are first rounded to multiples of 1/steps, so
+    there are at most steps + 1 calls however many vertices there are.
+
+    Kept the same in height.py, slope.py, visiblevertices.py and 
+    weighttovertexcolor.py, these add-ons are installed one by one.
+    """
+    weights = np.asarray(weights, dtype=np.float32)
+    if steps > 0:
+        weights = np.round(np.clip(weights, 0, 1) * steps) / np.float32(steps)
+    if indices is None:
+        indices = np.arange(len(weights))
+    indices = np.asarray(indices)
+    values, inverse = np.unique(weights, return_inverse=True)
+    order = np.argsort(inverse.ravel(), kind='stable')
+    bounds = np.searchsorted(inverse.ravel()[order], np.arange(len(values) + 1)).tolist()
+    for k, w in enumerate(values.tolist()):
+        vertex_group.add(indices[order[bounds[k]:bounds[k + 1]]].tolist(), w, 'REPLACE')
+
+
 class Slope:
 
     def weight(self, normal, reference=Vector((0, 0, 1))):
@@ -85,6 +109,12 @@ class Slope2VGroup(bpy.types.Operator, Slope):
         description="Use world space instead of object space coordinates",
         default=False,
     )
+    steps: bpy.props.IntProperty(
+        name="Weight steps",
+        description="Round weights to multiples of 1/steps so vertices with equal weights are added together, 0 keeps them exact",
+        default=1024,
+        min=0,
+    )
 
     @classmethod
     def poll(self, context):
@@ -107,8 +137,7 @@ class Slope2VGroup(bpy.types.Operator, Slope):
         reference = Vector((0, 0, 1))
         if self.worldspace:
             reference = reference @ wmat
-        for v in mesh.vertices:
-            vertex_group.add([v.index], self.weight(v.normal, reference), "REPLACE")
+        set_weights(vertex_group, [self.weight(v.normal, reference) for v in mesh.vertices], steps=self.steps)
         bpy.ops.object.mode_set(mode="WEIGHT_PAINT")
         bpy.ops.object.mode_set(mode="EDIT")
         bpy.ops.object.mode_set(mode="WEIGHT_PAINT")
@@ -34,16 +34,411 @@ bl_info = {
 	"category": "Mesh"}
 
 import bpy
-from bpy.props import BoolProperty, FloatProperty
+from bpy.props import BoolProperty, FloatProperty, EnumProperty, IntProperty
 from mathutils import Vector
-from mathutils.geometry import intersect_ray_tri
+import numpy as np
 
-def intersect_ray_quad_3d(quad, origin, destination):
-	ray = destination - origin
-	p = intersect_ray_tri(quad[0],quad[1],quad[2],ray,origin)
-	if p is None:
-		p = intersect_ray_tri(quad[2],quad[3],quad[0],ray,origin)
-	return p
+def set_weights(vertex_group, weights, indices=None, steps=0):
+	"""
+	Assign weights[i] to vertex indices[i] (to vertex i if indices is None)
+	with a single vertex_group.add() call for every distinct weight. With
+	steps > 0 the weights are first rounded to multiples of 1/steps, so
+	there are at most steps + 1 calls however many vertices there are.
+
+	Kept the same in height.py, slope.py, visiblevertices.py and 
+	weighttovertexcolor.py, these add-ons are installed one by one.
+	"""
+	weights = np.asarray(weights, dtype=np.float32)
+	if steps > 0:
+		weights = np.round(np.clip(weights, 0, 1) * steps) / np.float32(steps)
+	if indices is None:
+		indices = np.arange(len(weights))
+	indices = np.asarray(indices)
+	values, inverse = np.unique(weights, return_inverse=True)
+	order = np.argsort(inverse.ravel(), kind='stable')
+	bounds = np.searchsorted(inverse.ravel()[order], np.arange(len(values) + 1)).tolist()
+	for k, w in enumerate(values.tolist()):
+		vertex_group.add(indices[order[bounds[k]:bounds[k + 1]]].tolist(), w, 'REPLACE')
+
+def vertex_coordinates(mesh, matrix):
+	"""
+	Return the (n,3) array of the coordinates of the mesh vertices, 
+	transformed by matrix.
+	"""
+	co = np.empty(len(mesh.vertices)*3, dtype=np.float32)
+	mesh.vertices.foreach_get('co', co)
+	m = np.array(matrix)
+	return co.reshape(-1,3).astype(np.float64) @ m[:3,:3].T + m[:3,3]
+
+def camera_coordinates(world, cam_mat):
+	"""Return the camera space coordinates of the (n,3) world space points."""
+	m = np.linalg.inv(np.array(cam_mat))
+	return world @ m[:3,:3].T + m[:3,3]
+
+def frame_bounds(view_frame, margin=0.0):
+	"""
+	Return the lower and upper corner of the camera frame in camera space,
+	grown by margin around its center, and the depth of the frame plane.
+	"""
+	frame = np.array([tuple(v) for v in view_frame])
+	center = np.mean(frame, axis=0)
+	frame = (frame - center)*(1 + margin) + center
+	return np.min(frame, axis=0), np.max(frame, axis=0), center[2]
+
+def frame_distances(world, cam_mat, view_frame, margin=0.0):
+	"""
+	Return for every point in world the distance along the line towards
+	the camera to the point where it crosses the camera frame, or nan if
+	it does not cross the frame on its way to the camera. Like a ray cast
+	this excludes points behind the camera and points in front of the 
+	frame. view_frame holds the frame corners in camera space, as returned
+	by Camera.view_frame(), margin grows the frame around its center.
+	"""
+	q = camera_coordinates(world, cam_mat)
+	lo, hi, z = frame_bounds(view_frame, margin)
+	with np.errstate(divide='ignore', invalid='ignore'):
+		s = z / q[:,2] # the line to the camera crosses the frame plane at s*q
+		x, y = s*q[:,0], s*q[:,1]
+		inside = (q[:,2] < 0) & (s < 1) & (x >= lo[0]) & (x <= hi[0]) & (y >= lo[1]) & (y <= hi[1])
+	d = (1 - s) * np.linalg.norm(np.array(cam_mat)[:3,3] - world, axis=1)
+	d[~inside] = np.nan
+	return d
+
+def occluder_triangles(context, objects=None):
+	"""
+	Return an (m,3,3) array with the world space corners of the triangles
+	of objects (all visible objects in the view layer if None), after 
+	modifiers.
+	"""
+	depsgraph = context.evaluated_depsgraph_get()
+	triangles = []
+	for ob in (context.visible_objects if objects is None else objects):
+		if ob.type not in {'MESH', 'CURVE', 'SURFACE', 'META', 'FONT'}:
+			continue
+		ob_eval = ob.evaluated_get(depsgraph)
+		mesh = ob_eval.to_mesh()
+		try:
+			mesh.calc_loop_triangles()
+			tri = np.empty(len(mesh.loop_triangles)*3, dtype=np.int32)
+			mesh.loop_triangles.foreach_get('vertices', tri)
+			triangles.append(vertex_coordinates(mesh, ob_eval.matrix_world)[tri].reshape(-1,3,3))
+		finally:
+			ob_eval.to_mesh_clear()
+	return np.concatenate(triangles) if triangles else np.zeros((0,3,3))
+
+# modifiers whose result may change over time without any animation data
+time_modifiers = {'CLOTH', 'SOFT_BODY', 'FLUID', 'FLUID_SIMULATION', 'SMOKE', 'DYNAMIC_PAINT',
+	'OCEAN', 'NODES', 'PARTICLE_SYSTEM', 'PARTICLE_INSTANCE', 'EXPLODE', 'WAVE', 'SURFACE',
+	'MESH_CACHE', 'MESH_SEQUENCE_CACHE'}
+
+def is_animated(ob, seen=None):
+	"""
+	Return True if the object might change from frame to frame: it or its
+	data have an action or drivers, it has shape keys, constraints, a rigid
+	body, particles or a simulation, geometry nodes or other time dependent
+	modifier, or its parent or an object (or collection) one of its
+	modifiers refers to is animated. When in doubt it is animated.
+	"""
+	seen = set() if seen is None else seen
+	if ob is None or ob.name in seen:
+		return False
+	seen.add(ob.name)
+	for id in (ob, ob.data):
+		anim = getattr(id, 'animation_data', None)
+		if anim is not None and (anim.action is not None or len(anim.drivers) or len(anim.nla_tracks)):
+			return True
+	if getattr(ob.data, 'shape_keys', None) is not None:
+		return True
+	if len(ob.constraints) or getattr(ob, 'rigid_body', None) is not None or getattr(ob, 'rigid_body_constraint', None) is not None:
+		return True
+	if len(getattr(ob, 'particle_systems', ())) or is_animated(ob.parent, seen):
+		return True
+	for mod in ob.modifiers:
+		if mod.type in time_modifiers:
+			return True
+		for prop in mod.bl_rna.properties:
+			if prop.type != 'POINTER' or prop.fixed_type is None:
+				continue
+			target = getattr(mod, prop.identifier)
+			if prop.fixed_type.identifier == 'Object' and is_animated(target, seen):
+				return True
+			if prop.fixed_type.identifier == 'Collection' and target is not None:
+				if any(is_animated(o, seen) for o in target.all_objects):
+					return True
+	return False
+
+class TriangleBVH:
+	"""
+	A bounding volume hierarchy over triangles that tests many line 
+	segments at once.
+
+	The triangles are cut into leaves of leafsize consecutive triangles,
+	the bottom level of a complete binary tree in heap layout (the 
+	children of node i are 2i+1 and 2i+2). Every node holds a fixed range
+	of triangles, so building it is ordering the triangles one level at a
+	time, every node moving the half of its range with the lowest centers
+	along the axis where they spread most to its left child, and a few 
+	array reductions. blocked() walks (segment, node) pairs down the
+	tree depth first in batches and tests the triangles of a leaf with
+	Moller-Trumbore as soon as a batch reaches it, so a segment is dropped
+	from the walk once any triangle blocks it.
+	"""
+
+	def __init__(self, triangles, leafsize=4):
+		tri = np.asarray(triangles, dtype=np.float64).reshape(-1,3,3)
+		n = len(tri)
+		self.leafsize = leafsize
+		self.level = int(np.ceil(np.log2(max(1, -(-n // leafsize)))))
+		if n:
+			centers = np.mean(tri, axis=1)
+			order = np.arange(n)
+			for level in range(self.level):
+				span = leafsize << (self.level - level) # triangles per node on this level
+				first = np.arange(0, n, span)
+				c = centers[order]
+				axis = np.argmax(np.maximum.reduceat(c, first) - np.minimum.reduceat(c, first), axis=1)
+				# one row per node, the last one padded, a partition per row is enough
+				key = np.full(len(first) * span, np.inf)
+				key[:n] = c[np.arange(n), np.repeat(axis, span)[:n]]
+				rows = np.argpartition(key.reshape(-1, span), span // 2 - 1, axis=1)
+				position = (rows + first[:,None]).ravel()
+				order = order[position[position < n]]
+			tri = tri[order]
+		# everything is kept per axis, gathering from 1D arrays is much faster
+		self.v0 = np.ascontiguousarray(tri[:,0].T)
+		self.e1 = np.ascontiguousarray((tri[:,1] - tri[:,0]).T)
+		self.e2 = np.ascontiguousarray((tri[:,2] - tri[:,0]).T)
+		self.n = n
+
+		# padding leaves get an empty box, inverted so it is easy to spot
+		nleaves = 1 << self.level
+		bbmin = np.full((2*nleaves - 1, 3), np.inf)
+		bbmax = np.full((2*nleaves - 1, 3), -np.inf)
+		if n:
+			first = np.arange(0, n, leafsize)
+			leaves = nleaves - 1 + np.arange(len(first))
+			bbmin[leaves] = np.minimum.reduceat(np.min(tri, axis=1), first)
+			bbmax[leaves] = np.maximum.reduceat(np.max(tri, axis=1), first)
+		for level in range(self.level - 1, -1, -1):
+			nodes = np.arange((1 << level) - 1, (1 << (level + 1)) - 1)
+			bbmin[nodes] = np.minimum(bbmin[2*nodes + 1], bbmin[2*nodes + 2])
+			bbmax[nodes] = np.maximum(bbmax[2*nodes + 1], bbmax[2*nodes + 2])
+		self.empty = bbmin[:,0] > bbmax[:,0]
+		self.bbmin = np.ascontiguousarray(bbmin.T)
+		self.bbmax = np.ascontiguousarray(bbmax.T)
+
+	def blocked(self, origins, ends, tmin=1e-4, chunk=16384):
+		"""
+		Return a boolean array that tells for every segment from origins[i]
+		to ends[i] if it crosses a triangle. Crossings closer to the origin
+		than tmin times the length of the segment are ignored, so a segment
+		that starts on a surface is not blocked by that surface.
+
+		The (segment, node) pairs still to test are kept on a stack of 
+		arrays and handled at most chunk at a time, the last ones pushed 
+		first, which are the children of the previous batch. Pairs of 
+		segments that were blocked in the meantime are skipped.
+		"""
+		origins = np.asarray(origins, dtype=np.float64).reshape(-1,3)
+		ends = np.broadcast_to(np.asarray(ends, dtype=np.float64), origins.shape)
+		result = np.zeros(len(origins), dtype=bool)
+		if self.n == 0:
+			return result
+		o = np.ascontiguousarray(origins.T)
+		d = ends.T - o
+		firstleaf = (1 << self.level) - 1
+		with np.errstate(divide='ignore', invalid='ignore', over='ignore'):
+			# a tiny instead of a zero component keeps the slab test right for segments parallel to an axis
+			inv = 1 / np.where(d == 0, 1e-300, d)
+			work = [(np.arange(len(origins)), np.zeros(len(origins), dtype=np.int64))]
+			while work:
+				seg, node = work.pop()
+				if len(seg) > chunk:
+					work.append((seg[:-chunk], node[:-chunk]))
+					seg, node = seg[-chunk:], node[-chunk:]
+				keep = ~result[seg]
+				seg, node = seg[keep], node[keep]
+
+				near = np.zeros(len(seg))
+				far = np.ones(len(seg))
+				for axis in range(3):
+					oa, ia = o[axis][seg], inv[axis][seg]
+					t1 = (self.bbmin[axis][node] - oa) * ia
+					t2 = (self.bbmax[axis][node] - oa) * ia
+					near = np.maximum(near, np.minimum(t1, t2))
+					far = np.minimum(far, np.maximum(t1, t2))
+				hit = (near <= far) & ~self.empty[node]
+				seg, node = seg[hit], node[hit]
+				leaf = node >= firstleaf
+				if not leaf.all():
+					s, n = seg[~leaf], node[~leaf]
+					work.append((np.concatenate((s, s)), np.concatenate((2*n + 1, 2*n + 2))))
+				seg, node = seg[leaf], node[leaf]
+				if len(seg) == 0:
+					continue
+
+				# one pair for every triangle in the leaves that were reached
+				start = (node - firstleaf) * self.leafsize
+				length = np.clip(self.n - start, 0, self.leafsize)
+				seg = np.repeat(seg, length)
+				first = np.cumsum(length) - length
+				t = np.repeat(start - first, length) + np.arange(len(seg))
+
+				# Moller-Trumbore, with the cross products written out per axis
+				dx, dy, dz = d[0][seg], d[1][seg], d[2][seg]
+				ax, ay, az = self.e1[0][t], self.e1[1][t], self.e1[2][t]
+				bx, by, bz = self.e2[0][t], self.e2[1][t], self.e2[2][t]
+				px, py, pz = dy*bz - dz*by, dz*bx - dx*bz, dx*by - dy*bx
+				det = ax*px + ay*py + az*pz
+				tx, ty, tz = o[0][seg] - self.v0[0][t], o[1][seg] - self.v0[1][t], o[2][seg] - self.v0[2][t]
+				u = (tx*px + ty*py + tz*pz) / det
+				qx, qy, qz = ty*az - tz*ay, tz*ax - tx*az, tx*ay - ty*ax
+				v = (dx*qx + dy*qy + dz*qz) / det
+				s = (bx*qx + by*qy + bz*qz) / det
+				hit = (u >= 0) & (v >= 0) & (u + v <= 1) & (s > tmin) & (s < 1)
+				result[seg[hit]] = True
+		return result
+
+def clip_near(tri, near):
+	"""
+	Return the parts of the camera space triangles tri (m,3,3) that lie 
+	beyond the near plane z = -near. A triangle with one corner in front 
+	of that plane becomes two triangles, one with two corners in front 
+	becomes one smaller triangle.
+	"""
+	front = tri[:,:,2] > -near
+	count = np.sum(front, axis=1)
+	parts = [tri[count == 0]]
+	for n in (1, 2):
+		t = tri[count == n]
+		# rotate the corners so the odd one out comes first
+		odd = np.argmax(front[count == n] == (n == 1), axis=1)
+		t = t[np.arange(len(t))[:,None], (odd[:,None] + np.arange(3)) % 3]
+		a, b, c = t[:,0], t[:,1], t[:,2]
+		ab = a + (b - a) * ((-near - a[:,2]) / (b[:,2] - a[:,2]))[:,None]
+		ac = a + (c - a) * ((-near - a[:,2]) / (c[:,2] - a[:,2]))[:,None]
+		if n == 1:
+			parts.append(np.stack((ab, b, c), axis=1))
+			parts.append(np.stack((ab, c, ac), axis=1))
+		else:
+			parts.append(np.stack((a, ab, ac), axis=1))
+	return np.concatenate(parts)
+
+class DepthBuffer:
+	"""
+	A software z-buffer of the camera view.
+
+	The triangles are moved to camera space, clipped at a near plane and
+	projected onto the camera frame (grown by margin), which is divided 
+	in resolution pixels horizontally. Every pixel keeps the largest 
+	1/depth of the triangles covering its center, 1/depth varies linearly
+	over a projected triangle. Triangles are rasterized in chunks of at 
+	most chunk (triangle, pixel) pairs, so the cost is proportional to 
+	the number of triangles plus the number of pixels they cover.
+	"""
+
+	def __init__(self, triangles, cam_mat, view_frame, margin=0.0, resolution=1024, chunk=1 << 22):
+		self.cam_mat = cam_mat
+		lo, hi, z = frame_bounds(view_frame, margin)
+		# bounds of the frame on the plane at distance 1
+		self.lo, self.hi = lo[:2] / -z, hi[:2] / -z
+		self.width = int(resolution)
+		self.height = max(1, int(round(self.width * (self.hi[1] - self.lo[1]) / (self.hi[0] - self.lo[0]))))
+		self.buffer = np.zeros(self.width * self.height)
+
+		tri = camera_coordinates(np.asarray(triangles, dtype=np.float64).reshape(-1,3), cam_mat).reshape(-1,3,3)
+		tri = clip_near(tri, 1e-3 * -z)
+		w = 1 / -tri[:,:,2]
+		x, y = self.pixels(tri[:,:,0] * w, tri[:,:,1] * w)
+		imin = np.maximum(np.ceil(np.min(x, axis=1) - 0.5), 0).astype(np.int64)
+		imax = np.minimum(np.floor(np.max(x, axis=1) - 0.5), self.width - 1).astype(np.int64)
+		jmin = np.maximum(np.ceil(np.min(y, axis=1) - 0.5), 0).astype(np.int64)
+		jmax = np.minimum(np.floor(np.max(y, axis=1) - 0.5), self.height - 1).astype(np.int64)
+		d = (x[:,1] - x[:,0])*(y[:,2] - y[:,0]) - (x[:,2] - x[:,0])*(y[:,1] - y[:,0])
+		keep = (imax >= imin) & (jmax >= jmin) & (d != 0)
+		x, y, w, d = x[keep], y[keep], w[keep], d[keep]
+		imin, jmin = imin[keep], jmin[keep]
+		across = imax[keep] - imin + 1
+		area = across * (jmax[keep] - jmin + 1)
+
+		# barycentric coordinates l1, l2 and 1/depth as linear functions of the pixel position
+		a1, b1 = (y[:,2] - y[:,0]) / d, (x[:,0] - x[:,2]) / d
+		a2, b2 = (y[:,0] - y[:,1]) / d, (x[:,1] - x[:,0]) / d
+		c1 = -(a1*x[:,0] + b1*y[:,0])
+		c2 = -(a2*x[:,0] + b2*y[:,0])
+		w0, dw1, dw2 = w[:,0], w[:,1] - w[:,0], w[:,2] - w[:,0]
+
+		end = np.cumsum(area)
+		first = 0
+		while first < len(area):
+			last = max(first + 1, int(np.searchsorted(end, end[first] - area[first] + chunk, side='right')))
+			t = np.repeat(np.arange(first, last), area[first:last])
+			k = np.arange(len(t)) - np.repeat(end[first:last] - area[first:last] - (end[first] - area[first]), area[first:last])
+			i = imin[t] + k % across[t]
+			j = jmin[t] + k // across[t]
+			cx, cy = i + 0.5, j + 0.5
+			l1 = a1[t]*cx + b1[t]*cy + c1[t]
+			l2 = a2[t]*cx + b2[t]*cy + c2[t]
+			inside = (l1 >= 0) & (l2 >= 0) & (l1 + l2 <= 1)
+			t, l1, l2 = t[inside], l1[inside], l2[inside]
+			np.maximum.at(self.buffer, (j*self.width + i)[inside], w0[t] + l1*dw1[t] + l2*dw2[t])
+			first = last
+
+	def pixels(self, sx, sy):
+		"""return the (fractional) pixel coordinates of points projected on the plane at distance 1"""
+		return ((sx - self.lo[0]) / (self.hi[0] - self.lo[0]) * self.width,
+			(sy - self.lo[1]) / (self.hi[1] - self.lo[1]) * self.height)
+
+	def occluded(self, world, bias=0.001):
+		"""
+		Return a boolean array that tells for every world space point in 
+		front of the camera if the buffer holds something closer to the
+		camera, by more than the fraction bias of its distance, at all 
+		four pixel centers around the point it projects to.
+
+		A point on a surface lies between those pixel centers and 1/depth
+		is linear over the surface, so it is never behind all four of them.
+		Comparing with a single pixel would let a surface seen at a grazing
+		angle hide itself, however small the pixels.
+		"""
+		q = camera_coordinates(world, self.cam_mat)
+		x, y = self.pixels(q[:,0] / -q[:,2], q[:,1] / -q[:,2])
+		i = np.floor(x - 0.5).astype(np.int64)
+		j = np.floor(y - 0.5).astype(np.int64)
+		closest = np.full(len(q), np.inf)
+		for di, dj in ((0,0), (1,0), (0,1), (1,1)):
+			pixel = np.clip(j + dj, 0, self.height - 1)*self.width + np.clip(i + di, 0, self.width - 1)
+			np.minimum(closest, self.buffer[pixel], out=closest)
+		return closest * -q[:,2] > 1 + bias
+
+class Occluders:
+	"""
+	The triangles of all visible objects, split in those of objects that
+	are not animated, which are collected once together with their BVH,
+	and those of animated objects, which are collected again by update().
+	"""
+
+	def __init__(self, context):
+		self.static = {ob.name for ob in context.visible_objects if not is_animated(ob)}
+		self.static_triangles = occluder_triangles(context, [ob for ob in context.visible_objects if ob.name in self.static])
+		self.static_bvh = None
+		self.update(context)
+
+	def update(self, context):
+		"""collect the triangles of the animated objects for the current frame"""
+		self.dynamic_triangles = occluder_triangles(context, [ob for ob in context.visible_objects if ob.name not in self.static])
+		self.dynamic_bvh = None
+
+	def triangles(self):
+		return np.concatenate((self.static_triangles, self.dynamic_triangles))
+
+	def blocked(self, origins, ends):
+		"""like TriangleBVH.blocked(), the BVH of the static triangles is only built once"""
+		if self.static_bvh is None:
+			self.static_bvh = TriangleBVH(self.static_triangles)
+		if self.dynamic_bvh is None:
+			self.dynamic_bvh = TriangleBVH(self.dynamic_triangles)
+		return self.static_bvh.blocked(origins, ends) | self.dynamic_bvh.blocked(origins, ends)
 
 def intersect_ray_scene(scene, view_layer, origin, destination):
 	direction = destination - origin
@@ -59,9 +454,20 @@ class VisibleVertices(bpy.types.Operator):
 	bl_options = {'REGISTER', 'UNDO'}
 
 	fullScene: BoolProperty(name="Full Scene", default=True, description="Check wether the view is blocked by objects in the scene.")
+	occlusion: EnumProperty(name="Occlusion", default='RAYCAST', description="How to check if the view is blocked",
+		items=[('RAYCAST', "Ray cast", "Cast a ray through the scene for every vertex"),
+			('BVH', "Triangle BVH", "Collect the triangles of all visible objects once and test all vertices in a few vectorized passes"),
+			('DEPTH', "Depth buffer", "Render the triangles of all visible objects into a depth buffer once and compare every vertex with it")])
+	depthResolution: IntProperty(name="Depth Resolution", default=2048, min=16, max=16384, description="Horizontal resolution of the depth buffer in pixels.")
+	depthBias: FloatProperty(name="Depth Bias", default=0.001, min=0.0, description="Fraction of its distance a vertex may lie behind the depth buffer and still be visible.")
 	distWeight: BoolProperty(name="Distance Weight", default=True, description="Give less weight to vertices further away from the camera.")
 	addModifier: BoolProperty(name="Add Modifier", default=True, description="Add a vertex weight modifier for additional control.")
+	weightSteps: IntProperty(name="Weight Steps", default=1024, min=0, description="Round weights to multiples of 1/steps so vertices with equal weights are added together, 0 keeps them exact.")
 	margin: FloatProperty(name="Camera Margin", default=0.0, description="Add extra margin to the visual area from te camera (might be negative as well).")
+	frameRange: BoolProperty(name="Frame Range", default=False, description="Check every frame from the start to the end frame of the scene instead of just the current frame.")
+	accumulate: EnumProperty(name="Accumulate", default='MAX', description="How the weights of the frames are combined",
+		items=[('MAX', "Maximum", "The largest weight a vertex gets in any frame"),
+			('FRACTION', "Fraction", "The average weight over all frames, without distance weight the fraction of frames a vertex is visible in")])
 
 	@classmethod
 	def poll(self, context):
@@ -70,6 +476,42 @@ class VisibleVertices(bpy.types.Operator):
 			isinstance(context.active_object.data, bpy.types.Mesh))
 		return p
 		
+	def frame_weights(self, context, world, occluders=None):
+		"""
+		Return the weights of the vertices at the (n,3) world space 
+		coordinates as seen from the scene camera in the current frame.
+		"""
+		scene = context.scene
+		cam_ob = scene.camera
+		cam = bpy.data.cameras[cam_ob.name] # camera in scene is object type, not a camera type
+		cam_mat = cam_ob.matrix_world
+		view_frame = cam.view_frame(scene=scene)	# without a scene the aspect ratio of the camera is not taken into account
+		cam_pos = cam_mat @ Vector((0,0,0))
+
+		distances = frame_distances(world, cam_mat, view_frame, self.margin) # check intersection with the camera frame
+		if self.fullScene and self.occlusion == 'BVH':
+			candidates = np.flatnonzero(~np.isnan(distances))
+			distances[candidates[occluders.blocked(world[candidates], cam_pos)]] = np.nan
+		elif self.fullScene and self.occlusion == 'DEPTH':
+			candidates = np.flatnonzero(~np.isnan(distances))
+			zbuffer = DepthBuffer(occluders.triangles(), cam_mat, view_frame, self.margin, self.depthResolution)
+			distances[candidates[zbuffer.occluded(world[candidates], self.depthBias)]] = np.nan
+		elif self.fullScene:
+			for vindex in np.flatnonzero(~np.isnan(distances)):
+				if intersect_ray_scene(scene, context.view_layer, Vector(world[vindex]), cam_pos):	# check intersection with all other objects in scene
+					distances[vindex] = np.nan
+
+		visible = ~np.isnan(distances)
+		weights = np.zeros(len(distances))
+		if visible.any():
+			min_distance = np.min(distances[visible])
+			drange = np.max(distances[visible]) - min_distance
+			if self.distWeight and drange > 1e-7:
+				weights[visible] = 1.0 - ((distances[visible] - min_distance) / drange)
+			else:
+				weights[visible] = distances[visible] > 0.0
+		return weights
+
 	def execute(self, context):
 		bpy.ops.object.mode_set(mode='OBJECT')
 
@@ -79,62 +521,42 @@ class VisibleVertices(bpy.types.Operator):
 			bpy.ops.object.vertex_group_add()
 			vertex_group = ob.vertex_groups.active
 		scene = context.scene
-		cam_ob = scene.camera
-		cam = bpy.data.cameras[cam_ob.name] # camera in scene is object type, not a camera type
-		cam_mat = cam_ob.matrix_world
-		view_frame = cam.view_frame(scene=scene)	# without a scene the aspect ratio of the camera is not taken into account
-		view_frame = [cam_mat @ v for v in view_frame]
-		cam_pos = cam_mat @ Vector((0,0,0))
-		view_center = sum(view_frame, Vector((0,0,0)))/len(view_frame)
-		view_normal = (view_center - cam_pos).normalized()
-
-		if self.margin != 0.0:
-			view_frame = [((v - view_center)*(1+self.margin))+view_center for v in view_frame] 
-		
-		mesh_mat = ob.matrix_world
-		mesh = ob.data
-		distances = []
-		max_distance = 0
-		min_distance = None
-		for v in mesh.vertices:
-			vertex_coords = mesh_mat @ v.co
-			d = None
-			intersection = intersect_ray_quad_3d(view_frame, vertex_coords, cam_pos) # check intersection with the camera frame
-			#print(intersection, end=" | ")
-			if intersection is not None:
-				d = (intersection - vertex_coords)
-				if d.dot(view_normal) < 0: # only take into account vertices in front of the camera, not behind it.
-					d = d.length
-					if self.fullScene:
-						if intersect_ray_scene(scene, context.view_layer, vertex_coords, cam_pos):	# check intersection with all other objects in scene. We revert the direction, ie. look from the camera to avoid self intersection
-							d = None
-				else:
-					d = None
-			if d is not None:
-				if d > max_distance :
-					max_distance = d
-				if min_distance is None or d < min_distance:
-					min_distance = d
-			distances.append((v.index, d))
-
-		drange = max_distance - min_distance if min_distance is not None else max_distance # prevent exception if the was not a single visible vertex
-		#print(min_distance, max_distance, drange)
-		if self.distWeight and drange > 1e-7:
-			#print("weighted")
-			for vindex, d in distances:
-				#print(d, end=' ')
-				if d is None:
-					vertex_group.add([vindex], 0.0, 'REPLACE')
-				else:
-					vertex_group.add([vindex], 1.0 - ((d - min_distance) / drange), 'REPLACE')
+		if self.frameRange:
+			current = scene.frame_current
+			frames = range(scene.frame_start, scene.frame_end + 1, scene.frame_step)
 		else:
-			#print("not weighted")
-			for vindex, d in distances:
-				#print(d, end='')
-				if d is None:
-					vertex_group.add([vindex], 0.0, 'REPLACE')
+			frames = [scene.frame_current]
+
+		# vertices and occluders that are not animated are only collected once
+		animated = is_animated(ob)
+		world = None
+		occluders = None
+		weights = np.zeros(len(ob.data.vertices))
+		wm = context.window_manager
+		wm.progress_begin(0, len(frames))
+		try:
+			for n, frame in enumerate(frames):
+				if self.frameRange:
+					scene.frame_set(frame)
+				if world is None or animated:
+					world = vertex_coordinates(ob.data, ob.matrix_world)
+				if self.fullScene and self.occlusion != 'RAYCAST':
+					if occluders is None:
+						occluders = Occluders(context)
+					else:
+						occluders.update(context)
+				w = self.frame_weights(context, world, occluders)
+				if self.accumulate == 'MAX':
+					np.maximum(weights, w, out=weights)
 				else:
-					vertex_group.add([vindex], 1.0 if d > 0.0 else 0.0, 'REPLACE')
+					weights += w / len(frames)
+				wm.progress_update(n + 1)
+		finally:
+			wm.progress_end()
+			if self.frameRange:
+				scene.frame_set(current)
+
+		set_weights(vertex_group, weights, steps=self.weightSteps)
 
 		bpy.ops.object.mode_set(mode='WEIGHT_PAINT')
 		bpy.ops.object.mode_set(mode='EDIT')
@@ -0,0 +1,92 @@
+import numpy as np
+import unittest
+
+try:
+	import visiblevertices
+except ImportError: # needs bpy, so only runs inside Blender
+	visiblevertices = None
+
+def moller_trumbore(triangles, origins, ends, tmin=1e-4):
+	"""brute force reference for TriangleBVH.blocked()"""
+	result = np.zeros(len(origins), dtype=bool)
+	for i, (o, e) in enumerate(zip(origins, ends)):
+		d = e - o
+		for v0, v1, v2 in triangles:
+			e1, e2 = v1 - v0, v2 - v0
+			p = np.cross(d, e2)
+			det = e1.dot(p)
+			if det == 0:
+				continue
+			t = o - v0
+			u = t.dot(p) / det
+			q = np.cross(t, e1)
+			v = d.dot(q) / det
+			s = e2.dot(q) / det
+			if u >= 0 and v >= 0 and u + v <= 1 and tmin < s < 1:
+				result[i] = True
+				break
+	return result
+
+@unittest.skipIf(visiblevertices is None, "needs bpy")
+class TestTriangleBVH(unittest.TestCase):
+
+	def test_random(self):
+		rng = np.random.default_rng(42)
+		triangles = rng.random((200,1,3)) * 10 + rng.normal(scale=0.5, size=(200,3,3))
+		origins = rng.random((300,3)) * 10
+		ends = np.array([5.0, 5.0, 20.0])
+		bvh = visiblevertices.TriangleBVH(triangles)
+		expected = moller_trumbore(triangles, origins, np.broadcast_to(ends, origins.shape))
+		np.testing.assert_array_equal(bvh.blocked(origins, ends), expected)
+		# batches smaller than the number of segments take several turns through the stack
+		np.testing.assert_array_equal(bvh.blocked(origins, ends, chunk=7), expected)
+
+	def test_axis_aligned(self):
+		# the segment runs along the z-axis in the plane x=0, exactly on the side of the bounding box
+		triangles = np.array([[[0,-1,1],[1,-1,1],[0,1,1]]], dtype=np.float64)
+		bvh = visiblevertices.TriangleBVH(triangles)
+		self.assertTrue(bvh.blocked(np.zeros((1,3)), np.array([0.0, 0.0, 5.0]))[0])
+		self.assertFalse(bvh.blocked(np.array([[-0.1, 0.0, 0.0]]), np.array([-0.1, 0.0, 5.0]))[0])
+
+	def test_empty(self):
+		bvh = visiblevertices.TriangleBVH(np.zeros((0,3,3)))
+		self.assertFalse(bvh.blocked(np.zeros((2,3)), np.ones(3)).any())
+
+def floor(nx, nz):
+	"""return the vertices and triangles of a floor at y=-1 in front of a camera at the origin"""
+	x, z = np.meshgrid(np.linspace(-20, 20, nx), np.linspace(-2, -60, nz))
+	vertices = np.stack([x, np.full_like(x, -1.0), z], -1).reshape(-1,3)
+	i, j = np.meshgrid(np.arange(nz-1), np.arange(nx-1), indexing='ij')
+	a = (i*nx + j).ravel()
+	faces = np.concatenate([np.stack([a, a+1, a+nx], 1), np.stack([a+1, a+nx+1, a+nx], 1)])
+	return vertices, vertices[faces]
+
+@unittest.skipIf(visiblevertices is None, "needs bpy")
+class TestDepthBuffer(unittest.TestCase):
+
+	cam_mat = np.eye(4) # looking down the -z axis
+	view_frame = [(1,0.5625,-2.78), (1,-0.5625,-2.78), (-1,-0.5625,-2.78), (-1,0.5625,-2.78)]
+
+	def test_grazing(self):
+		# a floor seen at a grazing angle must not hide itself
+		vertices, triangles = floor(101, 146)
+		visible = ~np.isnan(visiblevertices.frame_distances(vertices, self.cam_mat, self.view_frame))
+		self.assertGreater(np.count_nonzero(visible), 1000)
+		for resolution in (256, 2048):
+			zbuffer = visiblevertices.DepthBuffer(triangles, self.cam_mat, self.view_frame, resolution=resolution)
+			self.assertFalse(zbuffer.occluded(vertices[visible]).any())
+
+	def test_wall(self):
+		vertices, triangles = floor(101, 146)
+		wall = np.array([[[-3,-2,-10],[3,-2,-10],[-3,0.5,-10]], [[3,-2,-10],[3,0.5,-10],[-3,0.5,-10]]], dtype=np.float64)
+		triangles = np.concatenate([triangles, wall])
+		visible = ~np.isnan(visiblevertices.frame_distances(vertices, self.cam_mat, self.view_frame))
+		points = vertices[visible]
+		occluded = visiblevertices.DepthBuffer(triangles, self.cam_mat, self.view_frame, resolution=1024).occluded(points)
+		blocked = visiblevertices.TriangleBVH(triangles).blocked(points, np.zeros(3))
+		self.assertGreater(np.count_nonzero(blocked), 100)
+		# the two only differ at the pixel sized edges of the wall
+		self.assertGreater(np.mean(occluded == blocked), 0.99)
+
+if __name__ == '__main__':
+	unittest.main()
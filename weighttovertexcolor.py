@@ -33,9 +33,32 @@ bl_info = {
 
 import bpy
 import bmesh
+import numpy as np
 from bpy.props import BoolProperty, FloatProperty, EnumProperty, IntProperty, FloatVectorProperty
 from mathutils import Vector, Color
 
+def set_weights(vertex_group, weights, indices=None, steps=0):
+    """
+    Assign weights[i] to vertex indices[i] (to vertex i if indices is None)
+    with a single vertex_group.add() call for every distinct weight. With
+    steps > 0 the weights are first rounded to multiples of 1/steps, so
+    there are at most steps + 1 calls however many vertices there are.
+
+    Kept the same in height.py, slope.py, visiblevertices.py and 
+    weighttovertexcolor.py, these add-ons are installed one by one.
+    """
+    weights = np.asarray(weights, dtype=np.float32)
+    if steps > 0:
+        weights = np.round(np.clip(weights, 0, 1) * steps) / np.float32(steps)
+    if indices is None:
+        indices = np.arange(len(weights))
+    indices = np.asarray(indices)
+    values, inverse = np.unique(weights, return_inverse=True)
+    order = np.argsort(inverse.ravel(), kind='stable')
+    bounds = np.searchsorted(inverse.ravel()[order], np.arange(len(values) + 1)).tolist()
+    for k, w in enumerate(values.tolist()):
+        vertex_group.add(indices[order[bounds[k]:bounds[k + 1]]].tolist(), w, 'REPLACE')
+
 def update_particle_systems(ob, vg):
     """
     Force an update for any particle system that refers to the given vertex group
@@ -74,6 +97,7 @@ class VertexColorToWeight(bpy.types.Operator):
     bl_description = "Convert active vertex color layer to weights"
 
     channel : EnumProperty (name="Channel", description="Channel to use as weight", items=[('R','Red','Red'),('G','Green','Green'),('B','Blue','Blue'),('M','All (Monochrome)','All (Monochrome)')])
+    steps : IntProperty (name="Weight steps", description="Round weights to multiples of 1/steps so vertices with equal weights are added together, 0 keeps them exact", default=1024, min=0)
 
     @classmethod
     def poll(self, context):
@@ -117,17 +141,14 @@ class VertexColorToWeight(bpy.types.Operator):
                 colors[vi] += Vector(vertex_colors[loop.index].color[:3])
                 corners[vi]+= 1.0
         if self.channel == 'R':
-            for vindex in colors:           
-                vertex_group.add([vindex], colors[vindex].x/corners[vindex], 'REPLACE')
+            weights = [colors[vindex].x/corners[vindex] for vindex in colors]
         elif self.channel == 'G':
-            for vindex in colors:           
-                vertex_group.add([vindex], colors[vindex].y/corners[vindex], 'REPLACE')
+            weights = [colors[vindex].y/corners[vindex] for vindex in colors]
         elif self.channel == 'B':
-            for vindex in colors:           
-                vertex_group.add([vindex], colors[vindex].z/corners[vindex], 'REPLACE')
+            weights = [colors[vindex].z/corners[vindex] for vindex in colors]
         else:
-            for vindex in colors:           
-                vertex_group.add([vindex], sum(colors[vindex]/corners[vindex])/3.0, 'REPLACE')
+            weights = [sum(colors[vindex]/corners[vindex])/3.0 for vindex in colors]
+        set_weights(vertex_group, weights, list(colors), self.steps)
 
         bpy.ops.object.mode_set(mode='WEIGHT_PAINT')
         bpy.ops.object.mode_set(mode='EDIT')